@@ -9,6 +9,8 @@ setup(
     classifiers=[
         "Framework :: Plone",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 2",
+        "Programming Language :: Python :: 3",
     ],
     keywords='',
     author='TN Tecnologia e Negocios',
@@ -16,10 +18,10 @@ setup(
     url='http://www.tecnologiaenegocios.com.br',
     packages=find_packages('src'),
     package_dir={'': 'src'},
+    package_data={'stubydoo': ['benchmark_baseline.json']},
     include_package_data=True,
     zip_safe=False,
     install_requires=[
         'setuptools',
-        'byteplay',
     ],
 )
@@ -1,5 +1,25 @@
-import byteplay
+import bisect
+import collections
+import functools
+import heapq
+import inspect
+import itertools
+import marshal
+import mmap
+import operator
+import pickle
 import re
+import struct
+import sys
+import threading
+import timeit
+import types
+import weakref
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
 
 function_type = type(lambda: None)
 
@@ -12,79 +32,319 @@ def _enforce_name_in_functions(attrs):
 
 def double(**kw):
     _enforce_name_in_functions(kw)
-    return type('double', (object,), kw)()
+    return _instantiate(_double_type, kw)
 
 
 def mock(**kw):
     _enforce_name_in_functions(kw)
+    kw.pop('__getattr__', None)
+    return _instantiate(_mock_type, kw)
 
-    def attribute_raiser(self, attribute):
-        raise UnexpectedAttributeAccessError(attribute)
 
-    kw['__getattr__'] = attribute_raiser
-    return type('mock', (object,), kw)()
+# Methods stubbed on doubles of a class must exist in it and be called as
+# it would be.  Attributes which aren't methods may come from anywhere, so
+# they aren't checked.
+def double_of(cls, **kw):
+    for attr, value in kw.items():
+        if isinstance(value, function_type):
+            _binding_plan(cls, attr)
+    _enforce_name_in_functions(kw)
+    return _instantiate(_double_type, dict(kw, _autospec_=cls))
+
+
+def _raise_unexpected_attribute_access(self, attribute):
+    raise UnexpectedAttributeAccessError(attribute)
+
+
+# Doubles, mocks and nulls are pickled as the name of their kind, the
+# attributes given to their generated type (if any) and their own
+# attributes, so that they can be handed to worker processes.  Stubs and
+# expectations set on them stay in the process that made them.
+def _reduce_double(self, protocol=None):
+    cls = self.__dict__.get('_old_class_', type(self))
+    state = dict((attr, value) for attr, value in self.__dict__.items()
+                 if attr not in _bookkeeping_attributes)
+    class_attrs = _generated_types.get(cls)
+    if class_attrs is None:
+        args = (cls.__name__,)
+    else:
+        args = (cls.__name__, dict((attr, _portable(attr, value))
+                                   for attr, value in class_attrs.items()))
+    if state:
+        return (_rebuild_double, args, state)
+    return (_rebuild_double, args)
+
+
+# Functions which can't be pickled by name, such as lambdas, are pickled by
+# their code when they don't close over anything.  The code is marshalled,
+# so it can only be loaded by the same version of Python, as it is by worker
+# processes.
+def _portable(attr, value):
+    if type(value) is not function_type or _importable(value):
+        return value
+    if value.__closure__:
+        raise pickle.PicklingError(
+            "Can't pickle the %r attribute of a double: %r refers to "
+            "variables of the function defining it" % (attr, value)
+        )
+    return _PortableFunction(value)
+
+
+def _importable(function):
+    target = sys.modules.get(function.__module__)
+    for name in getattr(function, '__qualname__', function.__name__).\
+            split('.'):
+        target = getattr(target, name, None)
+    return target is function
+
+
+class _PortableFunction(object):
+
+    def __init__(self, function):
+        self.function = function
+
+    def __reduce__(self):
+        function = self.function
+        return (_rebuild_function, (
+            marshal.dumps(function.__code__), function.__module__,
+            function.__name__, function.__defaults__,
+            _kwdefaults(function),
+        ))
+
+
+def _rebuild_function(code, module, name, defaults, kwdefaults):
+    __import__(module)
+    function = types.FunctionType(marshal.loads(code),
+                                  sys.modules[module].__dict__, name,
+                                  defaults)
+    if kwdefaults:
+        function.__kwdefaults__ = kwdefaults
+    return function
+
+
+def _set_double_state(self, state):
+    self.__dict__.update(state)
+
+
+def _rebuild_double(kind, class_attrs=None):
+    return _interned_types.get(_base_types[kind], class_attrs or {})()
+
+
+_bookkeeping_attributes = frozenset(['_old_class_', '_expectations_'])
+_pickling_methods = {
+    '__reduce_ex__': _reduce_double,
+    '__setstate__': _set_double_state,
+}
+
+_double_type = type('double', (object,), dict(_pickling_methods))
+_mock_type = type('mock', (object,), dict(
+    _pickling_methods,
+    __getattr__=_raise_unexpected_attribute_access,
+))
+
+
+def _instantiate(base, attrs):
+    class_attrs, instance_attrs = _split_attributes(attrs)
+    instance = _interned_types.get(base, class_attrs)()
+    if instance_attrs:
+        instance.__dict__.update(instance_attrs)
+    return instance
+
+
+def _split_attributes(attrs):
+    # Descriptors (functions included) and special names only work when set
+    # on the class.  Anything else can live in the instance's dictionary.
+    class_attrs, instance_attrs = {}, {}
+    for attr, value in attrs.items():
+        if hasattr(type(value), '__get__') or \
+                (attr.startswith('__') and attr.endswith('__')):
+            class_attrs[attr] = value
+        else:
+            instance_attrs[attr] = value
+    return class_attrs, instance_attrs
+
+
+# Doubles, mocks and nulls built with the same functions under the same
+# names share their generated type.  Only the most recently used types are
+# kept around.
+#
+# Types are looked up by the very values they were built with, and failing
+# that by what their functions are made of, so that an inline lambda, a new
+# function each time, still finds its type.  What functions refer to is
+# compared by identity, and kept alive along with the type so that
+# identities can't be reused while in the key.
+class InternedTypes(object):
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._types = collections.OrderedDict()
+
+    def get(self, base, class_attrs):
+        if not class_attrs:
+            return base
+        referents = []
+        try:
+            key = (base, frozenset(class_attrs.items()))
+            entry = self._types.pop(key, None)
+            if entry is None:
+                shape = (base, frozenset([
+                    (attr, _function_key(value, referents))
+                    for attr, value in class_attrs.items()
+                ]))
+                if referents:
+                    entry = self._types.pop(shape, None)
+                    if entry is not None:
+                        self._types[shape] = entry
+                        return entry[0]
+        except TypeError:
+            return self._generate(base, class_attrs)
+        if entry is None:
+            entry = (self._generate(base, class_attrs), ())
+            if referents:
+                self._store(shape, (entry[0], referents))
+        self._store(key, entry)
+        return entry[0]
+
+    def _store(self, key, entry):
+        if len(self._types) >= self.maxsize:
+            self._types.popitem(last=False)
+        self._types[key] = entry
+
+    def clear(self):
+        self._types.clear()
+
+    def __len__(self):
+        return len(self._types)
+
+    def _generate(self, base, class_attrs):
+        generated = type(base.__name__, (base,),
+                         dict(class_attrs, __slots__=()))
+        _generated_types[generated] = class_attrs
+        return generated
+
+
+def _function_key(value, referents):
+    if type(value) is not function_type or value.__dict__:
+        return value
+    defaults, closure = value.__defaults__, value.__closure__
+    kwdefaults = _kwdefaults(value)
+    code = value.__code__
+    referents.append(code)
+    if defaults is None and closure is None and not kwdefaults:
+        return (function_type, id(code))
+    parts = list(defaults or ())
+    for name in sorted(kwdefaults or ()):
+        parts.append(name)
+        parts.append(kwdefaults[name])
+    if closure is not None:
+        # The cells, not what they hold: that may change afterwards.
+        parts.extend(closure)
+    referents.extend(parts)
+    return (function_type, id(code), len(parts) - len(closure or ()),
+            tuple(map(id, parts)))
+
+
+if hasattr(function_type, '__kwdefaults__'):
+    _kwdefaults = operator.attrgetter('__kwdefaults__')
+else:
+    def _kwdefaults(function):
+        return None
+
+
+_interned_types = InternedTypes()
+
+# The attributes each generated type was built with, for pickling.  Kept
+# apart from the interned types since instances may outlive the cache.
+_generated_types = weakref.WeakKeyDictionary()
+
+
+def _return_self(self, *args, **kw):
+    return self
+
+
+def _null_delattr(self, attr):
+    self.__dict__.pop(attr, None)
+
+
+_null_methods = [
+    '__pos__', '__neg__', '__abs__',
+    '__add__', '__radd__', '__sub__', '__rsub__', '__mul__', '__rmul__',
+    '__div__', '__rdiv__', '__truediv__', '__rtruediv__',
+    '__floordiv__', '__rfloordiv__', '__mod__', '__rmod__',
+    '__pow__', '__rpow__', '__lshift__', '__rlshift__',
+    '__rshift__', '__rrshift__', '__and__', '__rand__',
+    '__or__', '__ror__', '__xor__', '__rxor__',
+    '__getattr__', '__getitem__', '__setitem__', '__delitem__', '__call__',
+]
+
+_null_type = type('null', (object,), dict(
+    [(name, _return_self) for name in _null_methods],
+    __delattr__=_null_delattr,
+    **_pickling_methods
+))
+
+_base_types = {
+    'double': _double_type,
+    'mock': _mock_type,
+    'null': _null_type,
+}
 
 
 def null(**kw):
     _enforce_name_in_functions(kw)
-    null_type = type('null', (object,), kw)
-    null_type.__pos__       = lambda self:              self
-    null_type.__neg__       = lambda self:              self
-    null_type.__abs__       = lambda self:              self
-    null_type.__add__       = lambda self, other:       self
-    null_type.__radd__      = lambda self, other:       self
-    null_type.__sub__       = lambda self, other:       self
-    null_type.__rsub__      = lambda self, other:       self
-    null_type.__mul__       = lambda self, other:       self
-    null_type.__rmul__      = lambda self, other:       self
-    null_type.__div__       = lambda self, other:       self
-    null_type.__rdiv__      = lambda self, other:       self
-    null_type.__floordiv__  = lambda self, other:       self
-    null_type.__rfloordiv__ = lambda self, other:       self
-    null_type.__mod__       = lambda self, other:       self
-    null_type.__rmod__      = lambda self, other:       self
-    null_type.__pow__       = lambda self, other:       self
-    null_type.__rpow__      = lambda self, other:       self
-    null_type.__lshift__    = lambda self, other:       self
-    null_type.__rlshift__   = lambda self, other:       self
-    null_type.__rshift__    = lambda self, other:       self
-    null_type.__rrshift__   = lambda self, other:       self
-    null_type.__and__       = lambda self, other:       self
-    null_type.__rand__      = lambda self, other:       self
-    null_type.__or__        = lambda self, other:       self
-    null_type.__ror__       = lambda self, other:       self
-    null_type.__xor__       = lambda self, other:       self
-    null_type.__rxor__      = lambda self, other:       self
-    null_type.__getattr__   = lambda self, attr:        self
-    null_type.__delattr__   = lambda self, attr:        self
-    null_type.__getitem__   = lambda self, key:         self
-    null_type.__setitem__   = lambda self, key, value:  self
-    null_type.__delitem__   = lambda self, key:         self
-    null_type.__call__      = lambda self, *a, **kw:    self
-    return null_type()
+    return _instantiate(_null_type, kw)
+
+
+def _expectations_of(instance):
+    # Bookkeeping attributes are read straight from the instance dictionary,
+    # so that doubles with their own __getattr__ (mocks and nulls) are not
+    # asked for them.
+    candidate = getattr(instance, '__dict__', {}).get('_expectations_')
+    if isinstance(candidate, Expectations):
+        return candidate
+    return None
 
 
 def _ensure_presence_of_expectations_object(instance):
-    if hasattr(instance, '_expectations_'):
-        candidate = getattr(instance, '_expectations_', None)
-        if candidate is None or not isinstance(candidate, Expectations):
-            expectations = Expectations()
-            expectations.patch_instance(instance)
-    else:
+    if _expectations_of(instance) is None:
         expectations = Expectations()
         expectations.patch_instance(instance)
 
 
+# The method is checked against the class before the instance is patched,
+# so that nothing is left to undo when it doesn't exist.  Normalizing the
+# arguments implies autospec.
+def _prepare_method(instance, method_name, autospec, normalize=False):
+    attrs = getattr(instance, '__dict__', {})
+    spec = attrs.get('_autospec_')
+    if spec is None and (autospec or normalize):
+        spec = attrs.get('_old_class_', type(instance))
+    plan = None if spec is None else _binding_plan(spec, method_name)
+    _ensure_presence_of_expectations_object(instance)
+    if plan is not None:
+        method_expectations = instance._expectations_[method_name]
+        method_expectations.plan = plan
+        if normalize:
+            method_expectations.normalize_arguments()
+
+
 _no_attribute_marker = object()
+_timer = timeit.default_timer
 
 
-def stub(instance_or_method, method_name=None, **attributes):
+def stub(instance_or_method, method_name=None, autospec=False,
+         normalize=False, **attributes):
     if attributes:
         instance = instance_or_method
-        replaced_attributes = getattr(instance, '_replaced_attributes_', {})
+        replaced_attributes = instance.__dict__.get('_replaced_attributes_',
+                                                    {})
         instance._replaced_attributes_ = replaced_attributes
+        journal = _journal()
         for attribute, value in attributes.items():
             original_value = getattr(instance, attribute, _no_attribute_marker)
+            journal.record(_restore_attribute, instance, attribute,
+                           _own_value(instance, attribute, original_value),
+                           attribute in replaced_attributes)
             if attribute not in replaced_attributes:
                 replaced_attributes[attribute] = original_value
             setattr(instance, attribute, value)
@@ -95,7 +355,7 @@ def stub(instance_or_method, method_name=None, **attributes):
             method = instance_or_method
             method_name = method.__name__
             instance = method.__self__
-        _ensure_presence_of_expectations_object(instance)
+        _prepare_method(instance, method_name, autospec, normalize)
         stub = MethodStub(instance, method_name)
         stub.set()
         return stub
@@ -104,9 +364,9 @@ def stub(instance_or_method, method_name=None, **attributes):
 def unstub(instance_or_method, *attributes):
     if attributes:
         instance = instance_or_method
-        if not hasattr(instance, '_replaced_attributes_'):
+        replaced_attributes = instance.__dict__.get('_replaced_attributes_')
+        if replaced_attributes is None:
             return
-        replaced_attributes = instance._replaced_attributes_
         attributes = [a for a in attributes if a in replaced_attributes]
         for attribute in attributes:
             original_value = replaced_attributes[attribute]
@@ -119,7 +379,7 @@ def unstub(instance_or_method, *attributes):
         method = instance_or_method
         instance = method.__self__
         method_name = method.__name__
-        expectations = getattr(instance, '_expectations_', None)
+        expectations = _expectations_of(instance)
         if expectations:
             expectations[method_name].discard_all()
             del expectations[method_name]
@@ -127,23 +387,134 @@ def unstub(instance_or_method, *attributes):
                 expectations.unpatch_instance()
 
 
-def expect(instance_or_method, method_name=None):
+# What an attribute must be set back to for the instance to be as it was:
+# class attributes which aren't data descriptors are just removed from the
+# instance.
+def _own_value(instance, attribute, value):
+    own_attributes = getattr(instance, '__dict__', {})
+    if attribute in own_attributes:
+        return own_attributes[attribute]
+    class_value = getattr(type(instance), attribute, _no_attribute_marker)
+    if hasattr(class_value, '__set__'):
+        return value
+    return _no_attribute_marker
+
+
+def _restore_attribute(instance, attribute, value, was_replaced):
+    replaced_attributes = instance.__dict__.get('_replaced_attributes_')
+    if replaced_attributes is None or attribute not in replaced_attributes:
+        return
+    if value is _no_attribute_marker:
+        delattr(instance, attribute)
+    else:
+        setattr(instance, attribute, value)
+    if not was_replaced:
+        del replaced_attributes[attribute]
+        if not replaced_attributes:
+            del instance._replaced_attributes_
+
+
+def expect(instance_or_method, method_name=None, autospec=False,
+           normalize=False):
     if method_name is not None:
         instance = instance_or_method
     else:
         method = instance_or_method
         method_name = method.__name__
         instance = method.__self__
-    _ensure_presence_of_expectations_object(instance)
+    _prepare_method(instance, method_name, autospec, normalize)
     expectation = MethodExpectation(instance, method_name)
     expectation.set()
-    _instances_with_expectations.add(instance)
+    _context().instances_with_expectations.add(instance)
     return expectation
 
 
-def patch(function):
+def spy(instance_or_method, method_name=None):
+    expectation = expect(instance_or_method, method_name).and_call_original()
+    expectation.any_number_of_times
+    expectation.satisfied = True
+    return expectation
+
+
+def stub_many(instance, table):
+    return _install_many(instance, table, MethodStub)
+
+
+def expect_many(instance, table):
+    installed = _install_many(instance, table, MethodExpectation)
+    _context().instances_with_expectations.add(instance)
+    return installed
+
+
+# The tables given to stub_many and expect_many map method names to a spec,
+# or a list of specs, each being a dict with any of these keys.
+_spec_keys = frozenset(['args', 'kwargs', 'returns', 'raises', 'yields',
+                        'runs'])
+_expectation_spec_keys = frozenset(['times', 'at_least', 'at_most'])
+# Of which a spec may only have one.
+_output_spec_keys = frozenset(['returns', 'raises', 'yields', 'runs'])
+
+
+def _install_many(instance, table, stub_class):
+    installed = {}
+    for method_name, specs in table.items():
+        _prepare_method(instance, method_name, False)
+        if isinstance(specs, dict):
+            installed[method_name] = _install_spec(instance, method_name,
+                                                   specs, stub_class)
+        else:
+            installed[method_name] = [
+                _install_spec(instance, method_name, spec, stub_class)
+                for spec in specs
+            ]
+    return installed
+
+
+def _install_spec(instance, method_name, spec, stub_class):
+    allowed_keys = _spec_keys
+    if stub_class is MethodExpectation:
+        allowed_keys = _spec_keys | _expectation_spec_keys
+    unknown_keys = set(spec) - allowed_keys
+    if unknown_keys:
+        raise TypeError("Unknown keys in spec for %r: %s" %
+                        (method_name, ', '.join(sorted(unknown_keys))))
+    output_keys = _output_spec_keys.intersection(spec)
+    if len(output_keys) > 1:
+        raise TypeError("More than one output in spec for %r: %s" %
+                        (method_name, ', '.join(sorted(output_keys))))
+
+    # Configured before being set, so that it is added to the method's
+    # expectations only once.
+    stub = stub_class(instance, method_name)
+    if 'args' in spec or 'kwargs' in spec:
+        stub.skip_arguments_verification = False
+        stub.arguments = ExpectationArguments(tuple(spec.get('args', ())),
+                                              spec.get('kwargs', {}))
+    if 'returns' in spec:
+        stub.and_return(spec['returns'])
+    if 'raises' in spec:
+        stub.and_raise(spec['raises'])
+    if 'yields' in spec:
+        stub.and_yield(*spec['yields'])
+    if 'runs' in spec:
+        stub.and_run(spec['runs'])
+    if 'times' in spec:
+        stub.exactly(spec['times'])
+    if 'at_least' in spec:
+        stub.at_least(spec['at_least'])
+    if 'at_most' in spec:
+        stub.at_most(spec['at_most'])
+    stub.set()
+    return stub
+
+
+def scope():
+    return Journal()
+
+
+def patch(function, scoped=False):
     def decorator(stub):
-        FunctionStub(function).patch(stub)
+        FunctionStub(function).patch(stub, scoped=scoped)
         return stub
     return decorator
 
@@ -153,22 +524,31 @@ _test_method_re = re.compile(r'^test[a-zA-Z_]*$')
 
 def assert_expectations(fn=None):
     def call_method_with_assertion(*args, **kw):
+        context = _context()
+        instances_with_expectations = context.instances_with_expectations
         try:
             if fn:
-                if len(_instances_with_expectations) > 0:
+                if len(instances_with_expectations) > 0:
                     raise ExpectationsNotVerifiedError
                 value = fn(*args, **kw)
             else:
                 value = None
 
-            for instance in _instances_with_expectations:
-                expectations = instance._expectations_
-                if not expectations.is_satisfied():
-                    raise ExpectationNotSatisfiedError
+            for expectation in context.shared_expectations:
+                expectation.refresh()
+            unsatisfied = context.unsatisfied_expectations
+            if _instrumentation is not None:
+                _instrumentation.emit('verify', not unsatisfied)
+            if unsatisfied:
+                raise ExpectationNotSatisfiedError(
+                    ', '.join(sorted(str(e) for e in unsatisfied))
+                )
             return value
         finally:
             _clear_expectations()
-            FunctionStub.clear_all()
+            FunctionStub.clear_context()
+            if _instrumentation is not None:
+                _instrumentation.emit('teardown')
 
     if fn:
         if isinstance(fn, type):
@@ -184,10 +564,14 @@ def assert_expectations(fn=None):
 
 
 def _clear_expectations():
-    for instance in _instances_with_expectations:
-        expectations = instance._expectations_
-        expectations.unpatch_instance()
-    _instances_with_expectations.clear()
+    context = _context()
+    context.rollback()
+    context.instances_with_expectations.clear()
+    context.sequence = CallSequence()
+    for expectation in list(context.unsatisfied_expectations):
+        expectation.untrack()
+    for expectation in list(context.shared_expectations):
+        expectation.release()
 
 
 class ExpectationsNotVerifiedError(AssertionError):
@@ -206,16 +590,437 @@ class UnexpectedCallError(UnexpectedAttributeAccessError):
     pass
 
 
+class SequenceExhaustedError(UnexpectedCallError):
+    pass
+
+
+class OrderViolationError(ExpectationNotSatisfiedError):
+
+    def __init__(self, expected, actual):
+        super(OrderViolationError, self).__init__(
+            "Expected call #%d, %s, got call #%d, %s" %
+            (expected.order + 1, expected, actual.order + 1, actual)
+        )
+        self.expected = expected
+        self.actual = actual
+
+
+# Kinds of argument values, as far as the exact-match index is concerned.
+# Plain values compare equal only to plain values with the same hash.
+# Builtin containers and arrays never compare equal to plain values.
+# Anything else is opaque: it may define __eq__ to match whatever it likes.
+_PLAIN, _CONTAINER, _OPAQUE = 0, 1, 2
+
+try:
+    _integer_types = [int, long]
+except NameError:
+    _integer_types = [int]
+
+_plain_types = frozenset([type(None), bool, int, float, complex,
+                          type(b''), type(u'')] + _integer_types)
+_container_types = frozenset([list, dict, set, frozenset])
+
+
+def _value_kind(value):
+    value_type = type(value)
+    if value_type in _plain_types:
+        return _PLAIN
+    if value_type is tuple:
+        kind = _PLAIN
+        for item in value:
+            kind = max(kind, _value_kind(item))
+        return kind
+    if value_type in _container_types or _is_array(value):
+        return _CONTAINER
+    return _OPAQUE
+
+
+# Arrays are recognized by their interface, so that NumPy isn't needed:
+# they have a shape, a dtype and their contents as bytes.  They are equal
+# when all three are.
+_array_types = weakref.WeakKeyDictionary()
+
+
+def _is_array(value):
+    value_type = type(value)
+    try:
+        return _array_types[value_type]
+    except KeyError:
+        is_array = _array_types[value_type] = \
+            hasattr(value_type, 'shape') and hasattr(value_type, 'dtype') \
+            and hasattr(value_type, 'tobytes')
+        return is_array
+
+
+def _arrays_equal(expected, other):
+    return other is expected or (
+        _is_array(other) and other.shape == expected.shape and
+        other.dtype == expected.dtype and other.tobytes() == expected.tobytes()
+    )
+
+
+# Large containers and arrays are looked up by a digest of their contents,
+# taken once when the expectation is set, and compared in full only with the
+# expectations having the same digest.  Equal values have equal digests:
+# the digest is the hash of a stand-in for the value which compares equal
+# whenever the values do, dicts and sets standing in as frozensets.  Values
+# holding anything but plain values, builtin containers and arrays can't be
+# digested, since it may compare equal to values with other hashes.
+_digest_marker = object()
+_undigestable = object()
+
+
+def _digest(value):
+    value_type = type(value)
+    try:
+        if value_type is list or value_type is tuple:
+            if _all_plain(value):
+                return hash(tuple(value))
+        elif value_type is dict:
+            if _all_plain(value) and _all_plain(value.values()):
+                return hash(frozenset(value.items()))
+        return hash(_stand_in(value))
+    except TypeError:
+        return None
+
+
+def _all_plain(values):
+    for item in values:
+        if type(item) not in _plain_types:
+            return False
+    return True
+
+
+def _stand_in(value):
+    value_type = type(value)
+    if value_type in _plain_types:
+        return value
+    if value_type is list or value_type is tuple:
+        return tuple([_stand_in(item) for item in value])
+    if value_type is dict:
+        return frozenset([(_stand_in(key), _stand_in(item))
+                          for key, item in value.items()])
+    if value_type is set or value_type is frozenset:
+        return frozenset([_stand_in(item) for item in value])
+    if _is_array(value):
+        return (_digest_marker, value.shape, value.dtype, value.tobytes())
+    raise TypeError('%r can not be digested' % value_type)
+
+
+# The key of the arguments in the index of payloads: plain values are
+# kept, containers and arrays replaced by their digests.  `known` maps the
+# ids of the payloads of expectations already set to their digests, so that
+# passing the very same object doesn't digest it again.
+def _payload_key(args, kwargs, known):
+    positional = []
+    for value in args:
+        part = _payload_part(value, known)
+        if part is _undigestable:
+            return None
+        positional.append(part)
+    keyword = []
+    for name, value in kwargs.items():
+        part = _payload_part(value, known)
+        if part is _undigestable:
+            return None
+        keyword.append((name, part))
+    return tuple(positional), frozenset(keyword)
+
+
+def _payload_part(value, known):
+    kind = _value_kind(value)
+    if kind == _PLAIN:
+        return value
+    if kind == _OPAQUE:
+        return _undigestable
+    entry = known.get(id(value))
+    if entry is not None and entry[0] is value:
+        return entry[1]
+    digest = _digest(value)
+    if digest is None:
+        return _undigestable
+    return (_digest_marker, digest)
+
+
+# Digesting a value takes a few times as long as comparing it, so the
+# expectations are just compared in order when there are only a few, and
+# small containers aren't digested at all.
+_payload_scan_limit = 4
+_large_payload = 64
+
+
+def _has_large_payload(arguments):
+    if type(arguments.args) is not tuple or \
+            type(arguments.kwargs) is not dict:
+        return False
+    for value in itertools.chain(arguments.args, arguments.kwargs.values()):
+        if _value_kind(value) == _CONTAINER and (
+                _is_array(value) or len(value) >= _large_payload):
+            return True
+    return False
+
+
+def _is_digest(part):
+    return type(part) is tuple and len(part) == 2 and \
+        part[0] is _digest_marker
+
+
+def _arguments_kind(args, kw):
+    kind = _PLAIN
+    for value in args:
+        kind = max(kind, _value_kind(value))
+    if kw:
+        for value in kw.values():
+            kind = max(kind, _value_kind(value))
+    return kind
+
+
+def _index_key(arguments):
+    kwargs = arguments.kwargs
+    if type(kwargs) is not dict or type(arguments.args) is not tuple:
+        return None
+    if _arguments_kind(arguments.args, kwargs) != _PLAIN:
+        return None
+    if kwargs:
+        return (arguments.args, frozenset(kwargs.items()))
+    return arguments.args
+
+
+def _position_of(entry):
+    return entry[0]
+
+
+# Matchers compare equal to the values they match, so they can be given as
+# arguments anywhere, even nested in other arguments.  Compared to other
+# matchers, they are equal if they are of the same kind and expect the same.
+class Matcher(object):
+
+    __hash__ = None
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def matches(self, value):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        if isinstance(other, Matcher):
+            return type(self) is type(other) and \
+                self.expected == other.expected
+        return self.matches(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.expected)
+
+
+class Anything(Matcher):
+
+    def __init__(self):
+        super(Anything, self).__init__(None)
+
+    def matches(self, value):
+        return True
+
+    def __repr__(self):
+        return '<Anything>'
+
+
+class InstanceOf(Matcher):
+
+    def matches(self, value):
+        return isinstance(value, self.expected)
+
+
+class Contains(Matcher):
+
+    def matches(self, value):
+        try:
+            for item in self.expected:
+                if item not in value:
+                    return False
+        except TypeError:
+            return False
+        return True
+
+
+class DictIncluding(Matcher):
+
+    def matches(self, value):
+        if not hasattr(value, 'keys'):
+            return False
+        for key, expected in self.expected.items():
+            try:
+                actual = value[key]
+            except (KeyError, IndexError, TypeError):
+                return False
+            if not expected == actual:
+                return False
+        return True
+
+
+class Regex(Matcher):
+
+    def __init__(self, pattern, flags=0):
+        super(Regex, self).__init__((pattern, flags))
+        self.regex = re.compile(pattern, flags)
+
+    def matches(self, value):
+        if not isinstance(value, _string_types):
+            return False
+        return self.regex.search(value) is not None
+
+
+class Satisfying(Matcher):
+
+    def matches(self, value):
+        return bool(self.expected(value))
+
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str,)
+
+
+def any_():
+    return Anything()
+
+
+def instance_of(*types):
+    return InstanceOf(types)
+
+
+def contains(*items):
+    return Contains(items)
+
+
+def dict_including(*mapping, **items):
+    return DictIncluding(dict(*mapping, **items))
+
+
+def regex(pattern, flags=0):
+    return Regex(pattern, flags)
+
+
+def satisfying(predicate):
+    return Satisfying(predicate)
+
+
+# Arguments with matchers are compiled into a check for each of them, run
+# in place of comparing whole tuples and dictionaries.
+def _compile_arguments(args, kwargs):
+    if type(args) is not tuple or type(kwargs) is not dict:
+        return None
+    for value in itertools.chain(args, kwargs.values()):
+        if isinstance(value, Matcher) or _is_array(value):
+            break
+    else:
+        return None
+    return (tuple(_check_for(value) for value in args),
+            dict((name, _check_for(value))
+                 for name, value in kwargs.items()))
+
+
+def _check_for(value):
+    if isinstance(value, Matcher):
+        return value.matches
+    if _is_array(value):
+        return functools.partial(_arrays_equal, value)
+    return functools.partial(operator.eq, value)
+
+
+# Matchers are only equal to matchers when comparing expected arguments,
+# so that with_args(1) doesn't replace with_args(any_()).
+def _same_pattern(expected, other):
+    if isinstance(expected, Matcher) or isinstance(other, Matcher):
+        return isinstance(expected, Matcher) and \
+            isinstance(other, Matcher) and expected == other
+    if _is_array(expected):
+        return _arrays_equal(expected, other)
+    if _is_array(other):
+        return False
+    return expected == other
+
+
+# Expectations with arguments which are matchers and plain values are
+# indexed on one of the plain values: its argument position (or name) and
+# the value itself.  Positions with None or booleans, which discriminate
+# the least, are only chosen if there is no other.  Patterns with other
+# arbitrary values aren't indexed, since these may compare equal to
+# anything.
+def _partial_key(arguments):
+    if arguments.compiled is None:
+        return None
+    kwargs = arguments.kwargs
+    chosen = None
+    with_matchers = False
+    for position, value in itertools.chain(
+            enumerate(arguments.args), sorted(kwargs.items())):
+        if isinstance(value, Matcher):
+            with_matchers = True
+            continue
+        kind = _value_kind(value)
+        if kind == _OPAQUE:
+            return None
+        if kind == _PLAIN and (chosen is None or
+                               (_weak_discriminator(chosen[1]) and
+                                not _weak_discriminator(value))):
+            chosen = (position, value)
+    return chosen if with_matchers else None
+
+
+def _weak_discriminator(value):
+    return value is None or type(value) is bool
+
+
 class ExpectationArguments(object):
 
+    __slots__ = ('args', 'kwargs', 'compiled')
+
     def __init__(self, args, kwargs):
         self.args = args
         self.kwargs = kwargs
+        self.compiled = _compile_arguments(args, kwargs)
 
     def __eq__(self, other):
         if not isinstance(other, ExpectationArguments):
             return False
-        return self.args == other.args and self.kwargs == other.kwargs
+        if self.compiled is None and other.compiled is None:
+            return self.matches(other.args, other.kwargs)
+        if self.compiled is None or other.compiled is None:
+            return False
+        args, kwargs = self.args, self.kwargs
+        if len(args) != len(other.args) or \
+                sorted(kwargs) != sorted(other.kwargs):
+            return False
+        for expected, value in zip(args, other.args):
+            if not _same_pattern(expected, value):
+                return False
+        for name, expected in kwargs.items():
+            if not _same_pattern(expected, other.kwargs[name]):
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def matches(self, args, kwargs):
+        compiled = self.compiled
+        if compiled is None:
+            return self.args == args and self.kwargs == kwargs
+        positional, keyword = compiled
+        if len(args) != len(positional) or len(kwargs) != len(keyword):
+            return False
+        for check, value in zip(positional, args):
+            if not check(value):
+                return False
+        for name, check in keyword.items():
+            if name not in kwargs or not check(kwargs[name]):
+                return False
+        return True
 
     def __str__(self):
         return "<Args positional: %r, keyword: %r>" % (self.args, self.kwargs)
@@ -231,11 +1036,12 @@ class Expectations(dict):
     def patch_instance(self, instance):
         self.instance = instance
         self.instance._old_class_ = self.instance.__class__
-        new_class = type(self.instance.__class__.__name__,
-                         (self.instance.__class__,),
-                         {})
-        self.instance.__class__ = new_class
+        self.instance.__class__ = _patched_class(self.instance.__class__)
         self.instance._expectations_ = self
+        self.key = _watch(_patched_instances, instance,
+                          '<%s object at %#x>' % (type(instance).__name__,
+                                                  id(instance)))
+        _journal().record(Expectations._restore_instance, self)
 
     def unpatch_instance(self):
         self.expectations_with_arguments = []
@@ -243,6 +1049,11 @@ class Expectations(dict):
         self.instance.__class__ = self.instance._old_class_
         delattr(self.instance, '_old_class_')
         delattr(self.instance, '_expectations_')
+        _patched_instances.pop(self.key, None)
+
+    def _restore_instance(self):
+        if _expectations_of(self.instance) is self:
+            self.unpatch_instance()
 
     def is_satisfied(self):
         for method_expectation in self.values():
@@ -253,43 +1064,112 @@ class Expectations(dict):
 
 class MethodExpectations(object):
 
+    __slots__ = ('instance', 'method_name', 'function', 'plan', 'normalize',
+                 'expectations_without_arguments', '_positional_index',
+                 '_keyword_index', '_partial_index', '_partial_positions',
+                 '_payload_index', '_payload_digests', '_unindexed',
+                 '_entries', '_next_position')
+
     def __init__(self, instance, method_name):
         self.instance = instance
         self.method_name = method_name
-        self.expectations_with_arguments = []
+        self.function = None
+        # Calls are checked against the signature of the real method when
+        # stubbed with autospec.  When normalizing, the arguments of both
+        # calls and expectations are bound to it before being compared, so
+        # that those given by name or by position, or left to their
+        # defaults, are looked up the same way.
+        self.plan = None
+        self.normalize = False
         self.expectations_without_arguments = []
+        # Expectations with arguments are kept in an exact-match index when
+        # all of their arguments are plain hashable values, in ordered lists
+        # under one of their plain values when the others are matchers (see
+        # _partial_key), in ordered lists under the digests of their
+        # containers and arrays (see _payload_key), and in an ordered list
+        # otherwise.  Every one of them gets a position, so that the first
+        # one set (in list order) still wins when many match.
+        self._positional_index = {}
+        self._keyword_index = {}
+        self._partial_index = {}
+        self._partial_positions = {}
+        self._payload_index = {}
+        # id -> [payload, digest, number of expectations with it]
+        self._payload_digests = {}
+        self._unindexed = []
+        self._entries = {}
+        self._next_position = 0
+
+    @property
+    def expectations_with_arguments(self):
+        return [expectation for _, expectation in self._ordered()]
 
+    # Returns the expectation with equal arguments which was replaced, if
+    # any.
     def add(self, expectation):
-        if (not self.expectations_with_arguments and
+        if (not self._entries and
                 not self.expectations_without_arguments):
             self._add_method()
 
         if expectation.skip_arguments_verification:
             self.expectations_without_arguments.append(expectation)
-        else:
-            self._add_expectation_with_arguments(expectation)
+            return None
+        return self._add_expectation_with_arguments(expectation)
 
     def discard(self, expectation):
-        for i, existing in enumerate(self.expectations_with_arguments):
-            if existing is expectation:
-                del self.expectations_with_arguments[i]
-                return
-        for i, existing in enumerate(self.expectations_without_arguments):
-            if existing is expectation:
-                del self.expectations_without_arguments[i]
+        if id(expectation) in self._entries:
+            self._remove_entry(expectation)
+            return
+        # Searched from the end, where the latest stubs are, since those
+        # are the first ones discarded when rolling back.
+        expectations = self.expectations_without_arguments
+        for i in range(len(expectations) - 1, -1, -1):
+            if expectations[i] is expectation:
+                del expectations[i]
                 return
 
     def discard_all(self):
+        for expectation in self._all_expectations():
+            expectation.untrack()
+            expectation.release()
         self._remove_method()
 
     def run(self, args, kw):
-        for expectation in self.expectations_with_arguments:
-            if expectation.matches(args, kw):
-                return expectation.run(args, kw)
+        if self.plan is not None and not self.normalize:
+            self.plan.bind(args, kw)
+        if _instrumentation is not None:
+            return _instrumentation.dispatch(self, args, kw)
+        expectation = self.select(args, kw)
+        if expectation is None:
+            raise UnexpectedCallError
+        return expectation.run(args, kw)
+
+    def select(self, args, kw):
+        if self.normalize:
+            args, kw = self.plan.bind(args, kw)
+        expectation = self._find(args, kw)
+        if expectation is not None:
+            return expectation
         if self.expectations_without_arguments:
-            last_set_expectation = self.expectations_without_arguments[-1]
-            return last_set_expectation.run(args, kw)
-        raise UnexpectedCallError
+            return self.expectations_without_arguments[-1]
+        return None
+
+    # Expectations set before are bound again, keeping their order.  All of
+    # them are bound before any is changed, in case one doesn't fit.
+    def normalize_arguments(self):
+        if self.normalize:
+            return
+        expectations = self.expectations_with_arguments
+        bound = [self.plan.bind(e.arguments.args, e.arguments.kwargs)
+                 for e in expectations]
+        self.normalize = True
+        for expectation in expectations:
+            self._remove_entry(expectation)
+        for expectation, (args, kwargs) in zip(expectations, bound):
+            expectation.arguments = ExpectationArguments(args, kwargs)
+            replaced = self.add(expectation)
+            if replaced is not None:
+                expectation._displace(replaced)
 
     def is_satisfied(self):
         for expectation in self._all_expectations():
@@ -297,26 +1177,225 @@ class MethodExpectations(object):
                 return False
         return True
 
+    def __str__(self):
+        return "<%s for %r on %r>" % (self.__class__.__name__,
+                                      self.method_name,
+                                      self.instance)
+
     def __nonzero__(self):
-        return bool(self.expectations_with_arguments or
-                    self.expectations_without_arguments)
+        return bool(self._entries or self.expectations_without_arguments)
+
+    __bool__ = __nonzero__
 
     def _add_method(self):
-        def fn(instance, *args, **kw):
-            return self.run(args, kw)
-        fn.__name__ = self.method_name
-        setattr(self.instance.__class__, self.method_name, fn)
+        if self.function is None:
+            def fn(instance, *args, **kw):
+                return self.run(args, kw)
+            fn.__name__ = self.method_name
+            self.function = fn
+        patched = self.instance.__class__
+        if _is_special(self.method_name):
+            patched = _private_class(self.instance)
+        _install_dispatcher(patched, self.method_name)
 
     def _remove_method(self):
-        delattr(self.instance.__class__, self.method_name)
+        self.function = None
 
     def _add_expectation_with_arguments(self, expectation):
-        for i, existing in enumerate(self.expectations_with_arguments):
-            if existing.arguments == expectation.arguments:
-                self.expectations_with_arguments[i] = expectation
+        arguments = expectation.arguments
+        key, index = self._index_for(arguments)
+        if index is None:
+            candidates = self._ordered()
+        elif index is self._partial_index:
+            # Only expectations with the same matchers and plain values are
+            # equal to it.
+            candidates = index.get(key, ())
+        elif index is self._payload_index:
+            # Besides those with the same digests, arbitrary objects may be
+            # equal to it.
+            candidates = sorted(self._unindexed + index.get(key, []),
+                                key=_position_of)
+        else:
+            candidates = self._unindexed
+            existing = index.get(key)
+            if existing is not None:
+                candidates = sorted(
+                    candidates + [(self._entries[id(existing)][0], existing)],
+                    key=_position_of
+                )
+        replaced = None
+        for position, existing in candidates:
+            if existing.arguments == arguments:
+                self._remove_entry(existing)
+                existing.untrack()
+                replaced = existing
                 break
         else:
-            self.expectations_with_arguments.append(expectation)
+            position = self._next_position
+            self._next_position += 1
+        self._insert_entry(expectation, key, index, position)
+        return replaced
+
+    def _insert_entry(self, expectation, key, index, position):
+        if index is None:
+            bisect.insort(self._unindexed, (position, expectation))
+        elif index is self._partial_index:
+            entries = index.get(key)
+            if entries is None:
+                entries = index[key] = []
+                self._partial_positions[key[0]] = \
+                    self._partial_positions.get(key[0], 0) + 1
+            bisect.insort(entries, (position, expectation))
+        elif index is self._payload_index:
+            index.setdefault(key, [])
+            bisect.insort(index[key], (position, expectation))
+            self._count_payloads(expectation.arguments, key, 1)
+        else:
+            index[key] = expectation
+        self._entries[id(expectation)] = (position, key, index)
+
+    def _remove_entry(self, expectation):
+        position, key, index = self._entries.pop(id(expectation))
+        if index is None:
+            del self._unindexed[bisect.bisect_left(self._unindexed,
+                                                   (position,))]
+        elif index is self._partial_index:
+            entries = index[key]
+            del entries[bisect.bisect_left(entries, (position,))]
+            if not entries:
+                del index[key]
+                count = self._partial_positions.pop(key[0]) - 1
+                if count:
+                    self._partial_positions[key[0]] = count
+        elif index is self._payload_index:
+            entries = index[key]
+            del entries[bisect.bisect_left(entries, (position,))]
+            if not entries:
+                del index[key]
+            self._count_payloads(expectation.arguments, key, -1)
+        else:
+            del index[key]
+
+    def _count_payloads(self, arguments, key, change):
+        positional, keyword = key
+        keyword = dict(keyword)
+        parts = itertools.chain(
+            zip(arguments.args, positional),
+            [(value, keyword[name])
+             for name, value in arguments.kwargs.items()]
+        )
+        digests = self._payload_digests
+        for value, part in parts:
+            if not _is_digest(part):
+                continue
+            entry = digests.get(id(value))
+            if entry is None:
+                digests[id(value)] = [value, part, change]
+                continue
+            entry[2] += change
+            if not entry[2]:
+                del digests[id(value)]
+
+    def _index_for(self, arguments):
+        key = _index_key(arguments)
+        if key is not None:
+            if arguments.kwargs:
+                return key, self._keyword_index
+            return key, self._positional_index
+        key = _partial_key(arguments)
+        if key is not None:
+            return key, self._partial_index
+        if _has_large_payload(arguments):
+            key = _payload_key(arguments.args, arguments.kwargs,
+                               self._payload_digests)
+            if key is not None:
+                return key, self._payload_index
+        return None, None
+
+    def _find(self, args, kw):
+        if not self._entries:
+            return None
+        kind = _arguments_kind(args, kw)
+        payloads = None
+        if kind == _CONTAINER and self._payload_index:
+            if len(self._payload_index) <= _payload_scan_limit:
+                payloads = self._payload_index.values()
+                payloads = heapq.merge(*payloads) if len(payloads) > 1 \
+                    else list(payloads)[0]
+            else:
+                key = _payload_key(args, kw, self._payload_digests)
+                if key is None:
+                    kind = _OPAQUE
+                else:
+                    payloads = self._payload_index.get(key)
+        if kind == _OPAQUE:
+            # Arbitrary objects may compare equal to anything, so every
+            # expectation with arguments must be tried, in order.
+            candidates = self._ordered()
+            candidate = limit = None
+        else:
+            candidates = self._unindexed
+            if self._partial_positions:
+                candidates = self._with_partial_candidates(candidates,
+                                                           args, kw)
+            if payloads:
+                candidates = heapq.merge(candidates, payloads) \
+                    if candidates else payloads
+            candidate = limit = None
+            if kind == _PLAIN:
+                if kw:
+                    candidate = self._keyword_index.get(
+                        (args, frozenset(kw.items()))
+                    )
+                else:
+                    candidate = self._positional_index.get(args)
+                if candidate is not None:
+                    if not candidates:
+                        return candidate
+                    limit = self._entries[id(candidate)][0]
+        for position, expectation in candidates:
+            if limit is not None and position > limit:
+                break
+            if expectation.matches(args, kw):
+                return expectation
+        return candidate
+
+    # Merges the expectations indexed under the plain values of the call
+    # with the given ones, keeping them in order.  Container values can't be
+    # equal to plain values, so there is nothing to look up for them.
+    def _with_partial_candidates(self, candidates, args, kw):
+        found = []
+        for position in self._partial_positions:
+            if type(position) is int:
+                if position >= len(args):
+                    continue
+                value = args[position]
+            elif position in kw:
+                value = kw[position]
+            else:
+                continue
+            if _value_kind(value) == _PLAIN:
+                entries = self._partial_index.get((position, value))
+                if entries is not None:
+                    found.append(entries)
+        if not found:
+            return candidates
+        if not candidates and len(found) == 1:
+            return found[0]
+        return heapq.merge(candidates, *found)
+
+    def _ordered(self):
+        entries = list(self._unindexed)
+        for entries_with_value in self._partial_index.values():
+            entries.extend(entries_with_value)
+        for entries_with_digest in self._payload_index.values():
+            entries.extend(entries_with_digest)
+        for index in (self._positional_index, self._keyword_index):
+            for expectation in index.values():
+                entries.append((self._entries[id(expectation)][0],
+                                expectation))
+        entries.sort(key=_position_of)
+        return entries
 
     def _all_expectations(self):
         for expectation in self.expectations_with_arguments:
@@ -325,32 +1404,264 @@ class MethodExpectations(object):
             yield expectation
 
 
+# Instances are patched by switching their class to a subclass generated
+# once per original class.  Stubbed methods are installed on that subclass
+# as dispatchers which look up each instance's own expectations, falling
+# back to the original class for instances which didn't stub the method.
+# Both are referenced weakly, the subclass being kept alive by its patched
+# instances, so that classes created in tests don't live forever.
+#
+# Special methods are looked up on the class only, skipping the instance's
+# expectations when falling back, and their mere presence changes how
+# instances behave (bool(), callable()...).  So instances stubbing them get
+# a subclass of their own, below the shared one.
+_patched_classes = weakref.WeakKeyDictionary()
+
+
+def _patched_class(cls):
+    reference = _patched_classes.get(cls)
+    patched = reference() if reference is not None else None
+    if patched is None:
+        patched = type(cls.__name__, (cls,), {'__slots__': ()})
+        _patched_classes[cls] = weakref.ref(patched)
+    return patched
+
+
+def _private_class(instance):
+    shared = _patched_class(instance.__dict__['_old_class_'])
+    cls = type(instance)
+    if cls is shared:
+        cls = instance.__class__ = type(cls.__name__, (cls,),
+                                        {'__slots__': ()})
+    return cls
+
+
+def _is_special(method_name):
+    return method_name.startswith('__') and method_name.endswith('__')
+
+
+def _install_dispatcher(patched, method_name):
+    dispatcher = patched.__dict__.get(method_name)
+    if not isinstance(dispatcher, MethodDispatcher):
+        setattr(patched, method_name, MethodDispatcher(patched, method_name))
+
+
+class MethodDispatcher(object):
+
+    def __init__(self, patched, method_name):
+        self.patched = patched
+        self.method_name = method_name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        expectations = instance.__dict__.get('_expectations_')
+        if expectations is not None:
+            method_expectations = dict.get(expectations, self.method_name)
+            if method_expectations is not None and \
+                    method_expectations.function is not None:
+                return types.MethodType(method_expectations.function,
+                                        instance)
+        try:
+            return getattr(super(self.patched, instance), self.method_name)
+        except AttributeError:
+            raise AttributeError("%r object has no attribute %r" %
+                                 (type(instance).__name__, self.method_name))
+
+
+# The method an instance would have if it weren't patched, bound to it.
+def _original_method(instance, method_name):
+    if _expectations_of(instance) is not None:
+        original = super(_patched_class(instance.__dict__['_old_class_']),
+                         instance)
+    else:
+        original = instance
+    try:
+        return getattr(original, method_name)
+    except AttributeError:
+        raise AttributeError("%r object has no attribute %r" %
+                             (getattr(instance, '_old_class_',
+                                      type(instance)).__name__,
+                              method_name))
+
+
+# How the arguments of calls bind to the parameters of a method, worked out
+# once per class and method name.  Methods of classes going away are
+# forgotten with them.
+_binding_plans = weakref.WeakKeyDictionary()
+
+
+def _binding_plan(cls, method_name):
+    plans = _binding_plans.get(cls)
+    if plans is None:
+        plans = _binding_plans[cls] = {}
+    try:
+        return plans[method_name]
+    except KeyError:
+        pass
+    for klass in inspect.getmro(cls):
+        if method_name in klass.__dict__:
+            attribute = klass.__dict__[method_name]
+            break
+    else:
+        raise AttributeError("%r object has no attribute %r" %
+                             (cls.__name__, method_name))
+    plan = plans[method_name] = BindingPlan.of(method_name, attribute)
+    return plan
+
+
+class BindingPlan(object):
+
+    __slots__ = ('name', 'names', 'positions', 'positional_only',
+                 'defaults', 'varargs', 'keyword_only', 'varkw')
+
+    def __init__(self, name, names, positional_only=0, defaults=None,
+                 varargs=False, keyword_only=(), varkw=False):
+        self.name = name
+        self.names = tuple(names)
+        self.positions = dict((n, i) for i, n in enumerate(self.names)
+                              if i >= positional_only)
+        self.positional_only = positional_only
+        self.defaults = defaults or {}
+        self.varargs = varargs
+        self.keyword_only = tuple(keyword_only)
+        self.varkw = varkw
+
+    # Returns None for attributes whose signature can't be known, which
+    # accept any arguments then.
+    @classmethod
+    def of(cls, name, attribute):
+        bound = True
+        if isinstance(attribute, staticmethod):
+            attribute, bound = attribute.__func__, False
+        elif isinstance(attribute, classmethod):
+            attribute = attribute.__func__
+        if not isinstance(attribute, function_type):
+            return None
+        try:
+            plan = cls(name, *_parameters_of(attribute))
+        except (TypeError, ValueError):
+            return None
+        if bound:
+            if not plan.names:
+                return None
+            plan = cls(name, plan.names[1:],
+                       max(0, plan.positional_only - 1), plan.defaults,
+                       plan.varargs, plan.keyword_only, plan.varkw)
+        return plan
+
+    # Raises TypeError for arguments the method wouldn't accept, otherwise
+    # returns them with the ones given by name to positional parameters and
+    # the missing ones with defaults moved into place, positionally.
+    def bind(self, args, kw):
+        names = self.names
+        count = len(names)
+        if len(args) == count and not kw and not self.keyword_only:
+            return args, kw
+        if len(args) > count and not self.varargs:
+            raise TypeError('%s() takes %d positional arguments but %d were '
+                            'given' % (self.name, count, len(args)))
+        values = list(args[:count])
+        values.extend([_no_attribute_marker] * (count - len(values)))
+        kwargs = {}
+        for name, value in kw.items():
+            position = self.positions.get(name)
+            if position is not None:
+                if values[position] is not _no_attribute_marker:
+                    raise TypeError('%s() got multiple values for argument '
+                                    '%r' % (self.name, name))
+                values[position] = value
+            elif name in self.keyword_only or self.varkw:
+                kwargs[name] = value
+            else:
+                raise TypeError('%s() got an unexpected keyword argument %r'
+                                % (self.name, name))
+        for position, value in enumerate(values):
+            if value is _no_attribute_marker:
+                values[position] = self._default(names[position])
+        for name in self.keyword_only:
+            if name not in kwargs:
+                kwargs[name] = self._default(name)
+        return tuple(values) + tuple(args[count:]), kwargs
+
+    def _default(self, name):
+        try:
+            return self.defaults[name]
+        except KeyError:
+            raise TypeError('%s() missing required argument %r' %
+                            (self.name, name))
+
+
+# Positional parameter names, how many of them are positional only, the
+# defaults by name, whether extra positional arguments are taken, the
+# keyword only parameter names and whether extra keyword arguments are
+# taken.
+if hasattr(inspect, 'signature'):
+    def _parameters_of(function):
+        names, defaults, keyword_only = [], {}, []
+        positional_only = 0
+        varargs = varkw = False
+        for parameter in inspect.signature(function).parameters.values():
+            kind = parameter.kind
+            if kind == parameter.VAR_POSITIONAL:
+                varargs = True
+                continue
+            if kind == parameter.VAR_KEYWORD:
+                varkw = True
+                continue
+            if kind == parameter.KEYWORD_ONLY:
+                keyword_only.append(parameter.name)
+            else:
+                if kind == parameter.POSITIONAL_ONLY:
+                    positional_only += 1
+                names.append(parameter.name)
+            if parameter.default is not parameter.empty:
+                defaults[parameter.name] = parameter.default
+        return (names, positional_only, defaults, varargs, keyword_only,
+                varkw)
+else:
+    def _parameters_of(function):
+        spec = inspect.getargspec(function)
+        defaults = dict(zip(reversed(spec.args),
+                            reversed(spec.defaults or ())))
+        return (spec.args, 0, defaults, spec.varargs is not None, (),
+                spec.keywords is not None)
+
+
+# Shared by every stub which doesn't verify its arguments.  Arguments are
+# never changed in place, only replaced.
+_no_arguments = ExpectationArguments((), {})
+
+
+# Stubs are kept in great numbers until the test is over, so they have no
+# instance dictionaries.  `_output` is the function called for the stub's
+# output, if any, in place of returning `output_value`.
 class BasicStub(object):
 
-    arguments = ExpectationArguments((), {})
-    skip_arguments_verification = True
-    output_value = None
-    satisfied = True
+    __slots__ = ('arguments', 'skip_arguments_verification', 'output_value',
+                 '_output', 'asynchronous', 'yields', 'awaits', '__weakref__')
 
-    @property
-    def arguments(self):
-        if getattr(self, '_arguments', None) is None:
-            self._arguments = ExpectationArguments((), {})
-        return self._arguments
+    satisfied = True
 
-    @arguments.setter
-    def arguments(self, value):
-        self._arguments = value
+    def __init__(self):
+        self.arguments = _no_arguments
+        self.skip_arguments_verification = True
+        self.output_value = None
+        self._output = None
+        self.asynchronous = None
+        self.yields = False
+        self.awaits = 0
 
     def and_return(self, value):
         self.output_value = value
         return self
 
     def and_yield(self, *args):
+        self.yields = True
         if len(args) == 1:
-            self.output = args[0]
+            self._output = args[0]
         else:
-            self.output = lambda *a, **kw: iter(args)
+            self._output = lambda *a, **kw: iter(args)
         return self
 
     def and_raise(self, exception, *exc_args, **exc_kwargs):
@@ -359,7 +1670,20 @@ class BasicStub(object):
         return self.and_run(fn)
 
     def and_run(self, fn):
-        self.output = fn
+        self._output = fn
+        return self
+
+    def and_return_sequence(self, iterable, on_exhaustion='raise'):
+        self._output = ReturnSequence(iterable, None, on_exhaustion)
+        return self
+
+    def and_return_from(self, generator, on_exhaustion='raise'):
+        if callable(generator) and not hasattr(generator, '__next__') and \
+                not hasattr(generator, 'next'):
+            self._output = ReturnSequence(generator(), generator,
+                                          on_exhaustion)
+        else:
+            self._output = ReturnSequence(generator, None, on_exhaustion)
         return self
 
     def with_args(self, *args, **kw):
@@ -369,25 +1693,51 @@ class BasicStub(object):
 
     def with_kwargs(self, kw):
         self.skip_arguments_verification = False
-        self.arguments.kwargs = kw
+        self.arguments = ExpectationArguments(self.arguments.args, kw)
         return self
 
     def matches(self, args, kw):
         if self.skip_arguments_verification:
             return True
-        return self.arguments == ExpectationArguments(args, kw)
+        return self.arguments.matches(args, kw)
 
     def run(self, args, kw):
-        return self.output(*args, **kw)
+        return self.respond(args, kw)
+
+    def respond(self, args, kw):
+        if self.asynchronous is None:
+            output = self._output
+            if output is None:
+                return self.output_value
+            return output(*args, **kw)
+        if self.yields or self.asynchronous is _ASYNC_GENERATOR:
+            return StubAsyncIterator(self, args, kw)
+        return StubAwaitable(self, args, kw)
 
     def output(self, *args, **kw):
-        return self.output_value
+        if self._output is None:
+            return self.output_value
+        return self._output(*args, **kw)
 
     @property
     def with_any_args(self):
         self.skip_arguments_verification = True
         return self
 
+    @property
+    def asynchronously(self):
+        self.asynchronous = _COROUTINE
+        return self
+
+    def track(self):
+        pass
+
+    def untrack(self):
+        pass
+
+    def release(self):
+        pass
+
     @property
     def to_be_called(self):
         return self
@@ -395,16 +1745,39 @@ class BasicStub(object):
 
 class MethodStub(BasicStub):
 
+    # `_displaced` has the stubs with equal arguments replaced by this one,
+    # given back to the method when it is withdrawn.
+    __slots__ = ('instance', 'method_name', '__name__', '_displaced')
+
     def __init__(self, instance, method_name):
+        super(MethodStub, self).__init__()
         self.instance = instance
         self.method_name = self.__name__ = method_name
+        self.asynchronous = _asynchronous_kind(instance, method_name)
+        self._displaced = ()
 
     def with_args(self, *args, **kw):
+        args, kw = self._bind(args, kw)
         result = super(MethodStub, self).with_args(*args, **kw)
         self._reorder_expectations()
         return result
 
     def with_kwargs(self, kw):
+        method_expectations = self.instance._expectations_[self.method_name]
+        if method_expectations.normalize:
+            # The positional arguments were bound already, with the ones
+            # given by name in their places.
+            args = list(self.arguments.args)
+            rest = {}
+            positions = method_expectations.plan.positions
+            for name, value in kw.items():
+                position = positions.get(name)
+                if position is not None and position < len(args):
+                    args[position] = value
+                else:
+                    rest[name] = value
+            return self.with_args(*args, **rest)
+        self._bind(self.arguments.args, kw)
         result = super(MethodStub, self).with_kwargs(kw)
         self._reorder_expectations()
         return result
@@ -429,36 +1802,164 @@ class MethodStub(BasicStub):
 
     def set(self):
         expectations = self.instance._expectations_[self.method_name]
-        expectations.add(self)
+        if not self.skip_arguments_verification:
+            arguments = self.arguments
+            args, kw = self._bind(arguments.args, arguments.kwargs)
+            if args is not arguments.args or kw is not arguments.kwargs:
+                self.arguments = ExpectationArguments(args, kw)
+        replaced = expectations.add(self)
+        if replaced is not None:
+            self._displace(replaced)
+        _journal().record(MethodStub._withdraw, self)
+        if _instrumentation is not None:
+            _instrumentation.emit('install', self)
 
     def unset(self):
         expectations = self.instance._expectations_[self.method_name]
         expectations.discard(self)
+        self.untrack()
+
+    # The original method is looked up once, and called directly in place of
+    # the stub's output.
+    def and_call_original(self):
+        self._output = _original_method(self.instance, self.method_name)
+        # Coroutine methods return their own awaitables.
+        self.asynchronous = None
+        return self
+
+    # Checks the arguments against the signature of the real method, if
+    # known, returning them bound to it when normalizing.
+    def _bind(self, args, kw):
+        method_expectations = self.instance._expectations_[self.method_name]
+        if method_expectations.plan is None:
+            return args, kw
+        bound = method_expectations.plan.bind(args, kw)
+        if method_expectations.normalize:
+            return bound
+        return args, kw
 
     def _reorder_expectations(self):
         expectations = self.instance._expectations_[self.method_name]
         expectations.discard(self)
-        expectations.add(self)
+        replaced = expectations.add(self)
+        if replaced is not None:
+            self._displace(replaced)
+
+    # The replaced expectation gives its shared call counter back while
+    # it's out; it gets another one, keeping its calls, if it comes back.
+    def _displace(self, replaced):
+        replaced.release()
+        if not self._displaced:
+            self._displaced = []
+        self._displaced.append(replaced)
+
+    # Undoes `set`: the method falls back to the stubs this one replaced,
+    # or to the original method when none is left.
+    def _withdraw(self):
+        expectations = _expectations_of(self.instance)
+        if expectations is None:
+            return
+        method_expectations = dict.get(expectations, self.method_name)
+        if method_expectations is None:
+            return
+        method_expectations.discard(self)
+        self.untrack()
+        self.release()
+        displaced, self._displaced = self._displaced, ()
+        for replaced in reversed(displaced):
+            method_expectations.add(replaced)
+            replaced.track()
+        if not method_expectations:
+            method_expectations._remove_method()
+            del expectations[self.method_name]
 
 
 class MethodExpectation(MethodStub):
 
+    __slots__ = ('_tracker', '_satisfied', 'min_calls', 'max_calls',
+                 'limit_calls', 'fail_if_called', 'calls', 'order',
+                 'sequence', 'counters', 'counter')
+
     def __init__(self, instance, method_name):
         super(MethodExpectation, self).__init__(instance, method_name)
-        self.satisfied = False
+        self._tracker = None
+        self._satisfied = False
         self.min_calls = self.max_calls = None
         self.limit_calls = True
         self.fail_if_called = False
         self.calls = 0
+        self.order = self.sequence = None
+        self.counters = self.counter = None
+
+    @property
+    def satisfied(self):
+        return self._satisfied
+
+    @satisfied.setter
+    def satisfied(self, value):
+        if value == self._satisfied:
+            return
+        self._satisfied = value
+        if self._tracker is not None:
+            if value:
+                self._tracker.discard(self)
+            else:
+                self._tracker.add(self)
+
+    def set(self):
+        super(MethodExpectation, self).set()
+        self.track()
+
+    def track(self):
+        context = _context()
+        self._tracker = context.unsatisfied_expectations
+        if not self._satisfied:
+            self._tracker.add(self)
+        if self.sequence is not None:
+            self.sequence.restore(self)
+        if _shared_calls is not None and self.counters is None:
+            self.counter = _shared_calls.allocate(self.calls)
+            self.counters = _shared_calls
+            context.shared_expectations.add(self)
+
+    def untrack(self):
+        if self._tracker is not None:
+            self._tracker.discard(self)
+            self._tracker = None
+        if self.sequence is not None:
+            self.sequence.remove(self)
+
+    # Takes the calls made by every process into account.
+    def refresh(self):
+        if self.counters is None or self._tracker is None:
+            return
+        self.calls = self.counters[self.counter]
+        # As in run: with no call at all, whatever was set up stands.
+        if not self.calls:
+            return
+        if self.limit_calls:
+            self._ensure_limits_of_calls_are_set()
+        self.satisfied = \
+            (self.min_calls is None or self.calls >= self.min_calls) and \
+            (self.max_calls is None or self.calls <= self.max_calls)
+
+    # Gives the shared call counter back, after reading the calls it got.
+    def release(self):
+        if self.counters is not None:
+            self.calls = self.counters[self.counter]
+            self.counters.release(self.counter)
+            self.counters = self.counter = None
+            _context().shared_expectations.discard(self)
 
     def exactly(self, times):
         self.min_calls = self.max_calls = times
-        if times == 0:
-            self.satisfied = True
+        self.satisfied = self.calls == times
         return self
 
     def at_least(self, times):
         self.min_calls = times
+        if self.calls < times:
+            self.satisfied = False
         return self
 
     def at_most(self, times):
@@ -469,7 +1970,9 @@ class MethodExpectation(MethodStub):
 
     @property
     def ordered(self):
-        raise NotImplementedError
+        if self.sequence is None:
+            _context().sequence.add(self)
+        return self
 
     @property
     def to_not_be_called(self):
@@ -499,13 +2002,18 @@ class MethodExpectation(MethodStub):
         return self
 
     def run(self, args, kw):
+        if self.sequence is not None:
+            self.sequence.advance(self)
         if self.limit_calls:
             self._ensure_limits_of_calls_are_set()
-        self.calls += 1
+        if self.counters is None:
+            self.calls += 1
+        else:
+            self.calls = self.counters.increment(self.counter)
         if self.max_calls is None or self.calls <= self.max_calls:
             if self.min_calls is None or self.calls >= self.min_calls:
                 self.satisfied = True
-            return self.output(*args, **kw)
+            return self.respond(args, kw)
         raise ExpectationNotSatisfiedError
 
     def _ensure_limits_of_calls_are_set(self):
@@ -513,80 +2021,808 @@ class MethodExpectation(MethodStub):
             self.exactly(1)
 
 
+_COROUTINE = 'coroutine'
+_ASYNC_GENERATOR = 'async generator'
+
+
+# Returns the values of an iterable, one per call, pulling them only when
+# needed.  When they run out, SequenceExhaustedError is raised, the last
+# one is repeated or they start over, given `on_exhaustion` is 'raise',
+# 'repeat' or 'cycle'.  Starting over calls `restart` for a new iterator,
+# iterates again over iterables which aren't iterators themselves, or else
+# goes over the values seen in the first pass, which are kept only for that.
+class ReturnSequence(object):
+
+    __slots__ = ('iterator', 'restart', 'on_exhaustion', 'last', 'seen',
+                 '_lock')
+
+    exhaustion_modes = ('raise', 'repeat', 'cycle')
+
+    def __init__(self, iterable, restart=None, on_exhaustion='raise'):
+        if on_exhaustion not in self.exhaustion_modes:
+            raise ValueError("on_exhaustion must be one of %s, not %r" %
+                             (', '.join(self.exhaustion_modes),
+                              on_exhaustion))
+        self.iterator = iter(iterable)
+        self.on_exhaustion = on_exhaustion
+        self.last = _no_attribute_marker
+        self.seen = None
+        if on_exhaustion == 'cycle' and restart is None:
+            if self.iterator is iterable:
+                self.seen = []
+            else:
+                restart = functools.partial(iter, iterable)
+        self.restart = restart
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kw):
+        with self._lock:
+            try:
+                value = next(self.iterator)
+            except StopIteration:
+                return self._exhausted()
+            if self.seen is not None:
+                self.seen.append(value)
+            self.last = value
+            return value
+
+    def _exhausted(self):
+        if self.on_exhaustion == 'repeat' and \
+                self.last is not _no_attribute_marker:
+            return self.last
+        if self.on_exhaustion == 'cycle':
+            if self.seen is not None:
+                self.restart = functools.partial(iter, self.seen)
+                self.seen = None
+            self.iterator = iter(self.restart())
+            for value in self.iterator:
+                return value
+        raise SequenceExhaustedError("No more values to return")
+
+
+# Ordered expectations, in the order they were declared.  The cursor is at
+# the expectation which must be called next; calling a later one moves it
+# forward, past expectations which must be satisfied by then.  As the
+# cursor never moves back, checking calls costs O(1), amortized.
+# Expectations withdrawn or replaced leave an empty place behind, which is
+# taken again if they come back.
+class CallSequence(object):
+
+    def __init__(self):
+        self.expectations = []
+        self.cursor = 0
+
+    def add(self, expectation):
+        expectation.order = len(self.expectations)
+        expectation.sequence = self
+        self.expectations.append(expectation)
+
+    def remove(self, expectation):
+        if self.expectations[expectation.order] is expectation:
+            self.expectations[expectation.order] = None
+
+    def restore(self, expectation):
+        self.expectations[expectation.order] = expectation
+
+    def advance(self, expectation):
+        order = expectation.order
+        cursor = self.cursor
+        if order == cursor:
+            return
+        expectations = self.expectations
+        if order > cursor:
+            while cursor < order and (expectations[cursor] is None or
+                                      expectations[cursor].satisfied):
+                cursor += 1
+            self.cursor = cursor
+            if cursor == order:
+                return
+        for expected in expectations[cursor:]:
+            if expected is not None:
+                break
+        raise OrderViolationError(expected, expectation)
+
+
+def _asynchronous_kind(instance, method_name):
+    original_class = getattr(instance, '__dict__', {}).get('_old_class_',
+                                                           type(instance))
+    original = getattr(original_class, method_name, None)
+    if original is None or not hasattr(inspect, 'iscoroutinefunction'):
+        return None
+    if inspect.isasyncgenfunction(original):
+        return _ASYNC_GENERATOR
+    if inspect.iscoroutinefunction(original):
+        return _COROUTINE
+    return None
+
+
+# What stubs of coroutine functions return: awaiting it runs the stub's
+# output and gives back its result, with no coroutine or closure involved.
+# Outputs which are awaitable themselves (coroutines from and_run, futures
+# given to and_return) are awaited in turn, as `yield from` would.
+class StubAwaitable(object):
+
+    __slots__ = ('stub', 'args', 'kw', 'delegate')
+
+    def __init__(self, stub, args, kw):
+        self.stub = stub
+        self.args = args
+        self.kw = kw
+        self.delegate = None
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    next = __next__
+
+    def send(self, value):
+        delegate = self.delegate
+        if delegate is None:
+            stub = self.stub
+            stub.awaits += 1
+            output = stub.output(*self.args, **self.kw)
+            delegate = self.delegate = _await_iterator(output)
+            if delegate is None:
+                raise StopIteration(output)
+            return next(delegate)
+        if value is None or not hasattr(delegate, 'send'):
+            return next(delegate)
+        return delegate.send(value)
+
+    def throw(self, exc_type, exc_value=None, traceback=None):
+        delegate = self.delegate
+        if delegate is not None and hasattr(delegate, 'throw'):
+            if exc_value is None:
+                return delegate.throw(exc_type)
+            return delegate.throw(exc_type, exc_value, traceback)
+        if exc_value is None:
+            raise exc_type
+        raise exc_value
+
+    def close(self):
+        if self.delegate is not None and hasattr(self.delegate, 'close'):
+            self.delegate.close()
+
+
+def _await_iterator(value):
+    await_ = getattr(type(value), '__await__', None)
+    if await_ is not None:
+        return await_(value)
+    # Generator based coroutines are their own iterators.
+    if hasattr(inspect, 'isawaitable') and inspect.isawaitable(value):
+        return value
+    return None
+
+
+# What stubs yielding values return for coroutine and asynchronous
+# generator functions.  It is its own awaitable for each step.
+class StubAsyncIterator(object):
+
+    __slots__ = ('stub', 'args', 'kw', 'iterator')
+
+    def __init__(self, stub, args, kw):
+        self.stub = stub
+        self.args = args
+        self.kw = kw
+        self.iterator = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = iter(self.stub.output(*self.args, **self.kw))
+        try:
+            value = next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+        raise StopIteration(value)
+
+    next = __next__
+
+    def send(self, value):
+        return self.__next__()
+
+    def throw(self, exc_type, exc_value=None, traceback=None):
+        if exc_value is None:
+            raise exc_type
+        raise exc_value
+
+    def close(self):
+        pass
+
+
 class InstanceExpectationsContainer(object):
     def __init__(self):
-        self._instances = set()
+        self._instances = {}
 
     def add(self, instance):
-        self._instances.add(instance)
+        key = id(instance)
+        if key not in self._instances:
+            self._instances[key] = _reference(instance,
+                                              self._forget(key))
 
     def clear(self):
-        self._instances = set()
+        self._instances = {}
 
     def __len__(self):
         return len(self._instances)
 
     def __iter__(self):
-        for instance in self._instances:
-            yield instance
+        for reference in list(self._instances.values()):
+            instance = reference()
+            if instance is not None:
+                yield instance
 
+    def _forget(self, key):
+        instances = self._instances
 
-_instances_with_expectations = InstanceExpectationsContainer()
+        def callback(reference):
+            if instances.get(key) is reference:
+                del instances[key]
+        return callback
 
 
-class FunctionStub(object):
+# Registries of patched objects only keep weak references to them (or
+# strong ones, to those which can't be referenced weakly), so that nothing
+# forgotten is kept alive by stubydoo.  Objects collected while patched are
+# described in `collected_while_patched`, which is left for the user to
+# inspect and empty, much like `gc.garbage`, but only the latest ones are
+# kept.
+collected_while_patched = collections.deque(maxlen=1000)
+_patched_instances = {}
+_patch_keys = itertools.count()
 
-    _patches = {}
 
-    def __init__(self, function):
-        self.function = function
+class _StrongReference(object):
+
+    __slots__ = ('target',)
+
+    def __init__(self, target):
+        self.target = target
+
+    def __call__(self):
+        return self.target
+
+
+def _reference(target, callback=None):
+    try:
+        return weakref.ref(target, callback)
+    except TypeError:
+        return _StrongReference(target)
+
+
+def _watch(registry, target, description):
+    key = next(_patch_keys)
+
+    def callback(reference):
+        if registry.pop(key, None) is not None:
+            collected_while_patched.append(description)
+    registry[key] = _reference(target, callback)
+    return key
+
+
+# Everything a test registers for later verification is kept in a context
+# of its own, so that tests running concurrently in different threads don't
+# see each other's expectations.  Each thread has one, shared by the
+# asyncio tasks it runs, so that expectations set inside a task are still
+# verified outside of it.  A task (or any contextvars context) wanting
+# expectations of its own calls isolate() first.
+class StubbingContext(object):
+
+    def __init__(self):
+        self.instances_with_expectations = InstanceExpectationsContainer()
+        self.function_stubs = weakref.WeakSet()
+        # Kept up to date by the expectations themselves, so verifying
+        # doesn't need to walk every instance and expectation.
+        self.unsatisfied_expectations = set()
+        self.sequence = CallSequence()
+        self.shared_expectations = set()
+        # Every change made by stubbing is recorded in the innermost
+        # journal; the first one lasts until the expectations are verified.
+        self.journals = [Journal()]
+
+    def rollback(self):
+        for journal in reversed(self.journals):
+            journal.rollback()
+
+
+_thread_locals = threading.local()
+
+
+def _thread_context():
+    context = getattr(_thread_locals, 'context', None)
+    if context is None:
+        context = _thread_locals.context = StubbingContext()
+    return context
+
+
+if contextvars is not None:
+    _current_context = contextvars.ContextVar('stubydoo_context',
+                                              default=None)
+
+    def _context():
+        context = _current_context.get()
+        if context is None:
+            return _thread_context()
+        return context
+
+    def isolate():
+        context = StubbingContext()
+        _current_context.set(context)
+        return context
+else:
+    _context = _thread_context
+
+    def isolate():
+        context = _thread_locals.context = StubbingContext()
+        return context
+
+
+def _journal():
+    return _context().journals[-1]
+
+
+# A journal keeps the inverse of each change made while it was the
+# innermost one, to undo them all in reverse order.  Used as a context
+# manager (see `scope`), it is the innermost journal within the block and
+# rolls back on exit, independently of the journals around it.  The
+# inverses do nothing if what they would undo was already undone.
+#
+# Each inverse is called with the changed object, which is referenced
+# weakly: there is nothing to undo on objects which no longer exist, and
+# their entries are dropped whenever the journal doubles in size.
+class Journal(object):
+
+    def __init__(self):
+        self.entries = []
+        self.context = None
+        self._limit = 1024
+
+    def record(self, undo, target, *args):
+        entries = self.entries
+        entries.append((undo, _reference(target), args))
+        if len(entries) > self._limit:
+            entries[:] = [entry for entry in entries if entry[1]() is not None]
+            self._limit = max(1024, 2 * len(entries))
+
+    def rollback(self):
+        entries = self.entries
+        while entries:
+            undo, reference, args = entries.pop()
+            target = reference()
+            if target is not None:
+                undo(target, *args)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        self.context = _context()
+        self.context.journals.append(self)
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        journals = self.context.journals
+        for i in range(len(journals) - 1, 0, -1):
+            if journals[i] is self:
+                del journals[i]
+                break
+        unsatisfied = None
+        if exc_type is None:
+            unsatisfied = self._unsatisfied_expectations()
+        self.rollback()
+        if unsatisfied:
+            raise ExpectationNotSatisfiedError(
+                ', '.join(sorted(str(e) for e in unsatisfied))
+            )
+
+    # The expectations set within the block are withdrawn with it, so they
+    # are verified on the way out rather than being dropped unmet.
+    def _unsatisfied_expectations(self):
+        tracked = self.context.unsatisfied_expectations
+        unsatisfied = set()
+        for undo, reference, args in self.entries:
+            expectation = reference()
+            if isinstance(expectation, MethodExpectation):
+                expectation.refresh()
+                if expectation in tracked:
+                    unsatisfied.add(expectation)
+        return unsatisfied
+
+
+# Opt-in instrumentation of stub installation, dispatch and verification.
+# While it is off, the hot paths only pay for checking `_instrumentation`.
+_instrumentation = None
+
 
-    def patch(self, stub):
-        self.unpatch()
+def instrument(instrumentation=None):
+    global _instrumentation
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    _instrumentation = instrumentation
+    return instrumentation
 
-        FunctionStub._patches[id(self.function)] = (stub, self.function)
-        _locals = {}
 
-        codestring = self._dedent("""
-        def wrapper(*__a, **__kw):
-            import stubydoo
-            return stubydoo.FunctionStub._patches[%d][0](*__a, **__kw)
-        """ % id(self.function))
+def stop_instrumenting():
+    global _instrumentation
+    _instrumentation = None
 
-        exec codestring in {}, _locals
-        wrapper = _locals['wrapper']
 
-        original_code = byteplay.Code.from_code(self.function.func_code)
-        code = byteplay.Code.from_code(wrapper.func_code)
+# When sharing calls, expectations count their calls in memory shared with
+# the processes forked after they were set, so that calls made in those
+# processes are seen when the expectations are verified.
+_shared_calls = None
 
-        code.freevars = original_code.freevars
-        self.function._original_func_code_ = self.function.func_code
-        self.function.func_code = code.to_code()
+
+def share_calls(capacity=4096):
+    global _shared_calls
+    _shared_calls = SharedCallCounters(capacity)
+    return _shared_calls
+
+
+def stop_sharing_calls():
+    global _shared_calls
+    _shared_calls = None
+
+
+_counter = struct.Struct('q')
+
+
+class SharedCallCounters(object):
+
+    def __init__(self, capacity=4096):
+        # Imported only when needed, as it takes a while to import.
+        import multiprocessing
+        self.capacity = capacity
+        self.memory = mmap.mmap(-1, capacity * _counter.size)
+        self.lock = multiprocessing.Lock()
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def allocate(self, value=0):
+        try:
+            index = self._free.pop()
+        except IndexError:
+            raise RuntimeError('All of the %d shared call counters are in '
+                               'use' % self.capacity)
+        _counter.pack_into(self.memory, index * _counter.size, value)
+        return index
+
+    def release(self, index):
+        self._free.append(index)
+
+    def increment(self, index):
+        offset = index * _counter.size
+        with self.lock:
+            value = _counter.unpack_from(self.memory, offset)[0] + 1
+            _counter.pack_into(self.memory, offset, value)
+        return value
+
+    def __getitem__(self, index):
+        with self.lock:
+            return _counter.unpack_from(self.memory,
+                                        index * _counter.size)[0]
+
+    def __len__(self):
+        return self.capacity - len(self._free)
+
+
+class StubStatistics(object):
+
+    def __init__(self, stub):
+        self.stub = stub
+        self.calls = 0
+        self.time = 0.0
+        self.misses = 0
+
+    def as_dict(self):
+        return {'stub': str(self.stub), 'calls': self.calls,
+                'time': self.time, 'misses': self.misses}
+
+
+# Hooks are called with the event's details:
+#
+#   install   (stub)                  a method stub or function stub was set
+#   call      (stub, args, kw, time)  a stub ran, taking `time` seconds
+#   miss      (method_expectations, args, kw)
+#                                     no stub matched, UnexpectedCallError
+#   verify    (satisfied)             assert_expectations checked everything
+#   teardown  ()                      assert_expectations cleaned up
+class Instrumentation(object):
+
+    events = ('install', 'call', 'miss', 'verify', 'teardown')
+
+    def __init__(self):
+        self.statistics = {}
+        self.hooks = dict((event, []) for event in self.events)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return instrument(self)
+
+    def __exit__(self, *exc_info):
+        stop_instrumenting()
+
+    def add_hook(self, event, hook):
+        self.hooks[event].append(hook)
+
+    def remove_hook(self, event, hook):
+        self.hooks[event].remove(hook)
+
+    def emit(self, event, *details):
+        for hook in self.hooks[event]:
+            hook(*details)
+
+    def dispatch(self, method_expectations, args, kw):
+        start = _timer()
+        expectation = method_expectations.select(args, kw)
+        if expectation is None:
+            self._statistics_of(method_expectations).misses += 1
+            self.emit('miss', method_expectations, args, kw)
+            raise UnexpectedCallError
+        return self._finish_call(expectation, expectation.run, args, kw,
+                                 start)
+
+    def call(self, function_stub, call, args, kw):
+        return self._finish_call(function_stub, call, args, kw, _timer())
+
+    def export(self, reset=False):
+        with self._lock:
+            records = [statistics.as_dict()
+                       for statistics in self.statistics.values()]
+            if reset:
+                self.statistics = {}
+        records.sort(key=lambda record: record['time'], reverse=True)
+        return records
+
+    def reset(self):
+        with self._lock:
+            self.statistics = {}
+
+    def _finish_call(self, stub, call, args, kw, start):
+        try:
+            return call(args, kw)
+        finally:
+            elapsed = _timer() - start
+            statistics = self._statistics_of(stub)
+            statistics.calls += 1
+            statistics.time += elapsed
+            self.emit('call', stub, args, kw, elapsed)
+
+    def _statistics_of(self, subject):
+        statistics = self.statistics.get(subject)
+        if statistics is None:
+            with self._lock:
+                statistics = self.statistics.setdefault(
+                    subject, StubStatistics(subject)
+                )
+        return statistics
+
+
+class FunctionStub(object):
+    # A function is either patched for everybody, with `stub` being called
+    # in place of its code, or in scoped mode, in which each context can
+    # have its own stub in `overrides` and the others get `stub`, if the
+    # function is also patched for everybody, or else the `original` code,
+    # run through a copy of the function.  `owner` is the context which
+    # patched it for everybody, which takes that patch away when cleared.
+    #
+    # The FunctionStub installed for a function is kept in the function
+    # itself.  `_patches` only refers weakly to the patched functions.
+
+    _patches = {}
+    _lock = threading.RLock()
+
+    def __init__(self, function):
+        self.function = function
+        self.stub = None
+        self.original = None
+        self.overrides = None
+        self.owner = None
+        self.key = None
+
+    def patch(self, stub, scoped=False):
+        context = _context()
+        with FunctionStub._lock:
+            installed = _installed_function_stub(self.function)
+            if installed is None:
+                installed = self
+                self._install()
+            if scoped:
+                if installed.overrides is None:
+                    if installed.original is None:
+                        installed._copy_original()
+                    installed.overrides = {}
+                previous = installed.overrides.get(context)
+                installed.overrides[context] = stub
+            else:
+                previous = installed.stub
+                installed.stub = stub
+                installed.owner = context
+            context.function_stubs.add(installed)
+        context.journals[-1].record(_restore_function, self.function,
+                                    context, stub, previous, scoped)
+        if _instrumentation is not None:
+            _instrumentation.emit('install', installed)
 
     def unpatch(self):
-        if self.is_patched():
-            self.function.func_code = self.function._original_func_code_
-            del FunctionStub._patches[id(self.function)]
-            del self.function._original_func_code_
+        with FunctionStub._lock:
+            if self.is_patched():
+                function = self.function
+                function.__code__ = function._original_func_code_
+                installed = function._function_stub_
+                FunctionStub._patches.pop(installed.key, None)
+                installed.overrides = installed.original = None
+                installed.stub = installed.owner = None
+                del function._original_func_code_, function._function_stub_
+
+    def unpatch_context(self, context):
+        with FunctionStub._lock:
+            if _installed_function_stub(self.function) is not self:
+                return
+            if self.overrides is not None:
+                self.overrides.pop(context, None)
+                if not self.overrides:
+                    self.overrides = None
+            if self.owner is context:
+                self.stub = self.owner = None
+            self._unpatch_if_unused()
+
+    def _unpatch_if_unused(self):
+        if self.stub is None and self.overrides is None:
+            self.unpatch()
+
+    def __str__(self):
+        return "<%s for %r>" % (self.__class__.__name__,
+                                self.function.__name__)
 
     def is_patched(self):
         marker = object()
         return getattr(self.function, '_original_func_code_', marker) \
             is not marker
 
-    def _dedent(self, codestring):
-        lines = codestring.split('\n')
-        code_lines = [l for l in codestring.split('\n') if l.strip()]
-        if not code_lines:
-            return codestring
-        first_line = code_lines[0]
-        indent_level = len(first_line) - len(first_line.lstrip())
-        new_lines = []
-        for line in lines:
-            new_lines.append(line[indent_level:])
-        return '\n'.join(new_lines)
+    def call(self, args, kw):
+        if _instrumentation is not None:
+            return _instrumentation.call(self, self._call, args, kw)
+        return self._call(args, kw)
+
+    def _call(self, args, kw):
+        overrides = self.overrides
+        if overrides is None:
+            return self.stub(*args, **kw)
+        stub = overrides.get(_context())
+        if stub is None:
+            stub = self.stub
+            if stub is None:
+                return self.original(*args, **kw)
+        return stub(*args, **kw)
+
+    def _install(self):
+        function = self.function
+        self.key = _watch(FunctionStub._patches, function,
+                          '<function %s at %#x>' % (function.__name__,
+                                                    id(function)))
+        code = function.__code__
+        function._original_func_code_ = code
+        function._function_stub_ = self
+        function.__code__ = _trampoline_code(code, weakref.proxy(self))
+
+    def _copy_original(self):
+        function = self.function
+        original = types.FunctionType(function._original_func_code_,
+                                      function.__globals__,
+                                      function.__name__,
+                                      function.__defaults__,
+                                      function.__closure__)
+        if hasattr(function, '__kwdefaults__'):
+            original.__kwdefaults__ = function.__kwdefaults__
+        self.original = original
+
+    @classmethod
+    def clear_context(cls):
+        context = _context()
+        for function_stub in list(context.function_stubs):
+            function_stub.unpatch_context(context)
+        context.function_stubs.clear()
 
     @classmethod
     def clear_all(cls):
-        for id, (stub, function) in list(cls._patches.items()):
-            FunctionStub(function).unpatch()
+        for reference in list(cls._patches.values()):
+            function = reference()
+            if function is not None:
+                FunctionStub(function).unpatch()
+
+
+def _installed_function_stub(function):
+    return getattr(function, '_function_stub_', None)
+
+
+# Undoes a FunctionStub.patch.  Patching again may have installed another
+# FunctionStub for the same function.
+def _restore_function(function, context, stub, previous, scoped):
+    with FunctionStub._lock:
+        installed = _installed_function_stub(function)
+        if installed is None:
+            return
+        if not scoped:
+            if installed.stub is stub:
+                installed.stub = previous
+                if previous is None:
+                    installed.owner = None
+                installed._unpatch_if_unused()
+        elif installed.overrides is not None and \
+                installed.overrides.get(context) is stub:
+            if previous is None:
+                del installed.overrides[context]
+                if not installed.overrides:
+                    installed.overrides = None
+                installed._unpatch_if_unused()
+            else:
+                installed.overrides[context] = previous
+
+
+# A patched function gets its code replaced by a trampoline calling the
+# `call` method of its FunctionStub, a weak proxy to which is stored in the
+# trampoline's constants (code objects aren't collected with cycles, the
+# function itself keeps its FunctionStub alive).  The trampoline must have
+# the same free variables as the original code (the function's closure
+# can't be changed), so one template is compiled for each layout of free
+# variables and then copied with the proper constants whenever a function
+# is patched.
+_trampoline_target = '__stubydoo_trampoline_target__'
+_trampoline_templates = {}
+
+
+def _trampoline_code(code, function_stub):
+    template = _trampoline_templates.get(code.co_freevars)
+    if template is None:
+        template = _compile_trampoline(code.co_freevars)
+        _trampoline_templates[code.co_freevars] = template
+    consts = tuple(function_stub if const == _trampoline_target else const
+                   for const in template.co_consts)
+    return _replace_code(template, co_consts=consts, co_name=code.co_name)
+
+
+def _compile_trampoline(freevars):
+    lines = ['def outer():']
+    if freevars:
+        lines.append('    %s = None' % ' = '.join(freevars))
+    lines.append('    def trampoline(*_stubydoo_args_, **_stubydoo_kw_):')
+    if freevars:
+        # Never run, but makes the free variables part of the code object.
+        lines.append('        if 0: %s' % ', '.join(freevars))
+    lines.append('        return %r.call(_stubydoo_args_, _stubydoo_kw_)' %
+                 _trampoline_target)
+    lines.append('    return trampoline')
+    namespace = {}
+    exec(compile('\n'.join(lines), '<stubydoo trampoline>', 'exec'),
+         namespace)
+    return namespace['outer']().__code__
+
+
+def _replace_code(code, **changes):
+    if hasattr(code, 'replace'):
+        return code.replace(**changes)
+    attrs = ['co_argcount', 'co_kwonlyargcount', 'co_nlocals', 'co_stacksize', 'co_flags',
+             'co_code', 'co_consts', 'co_names', 'co_varnames', 'co_filename',
+             'co_name', 'co_firstlineno', 'co_lnotab', 'co_freevars',
+             'co_cellvars']
+    if not hasattr(code, 'co_kwonlyargcount'):
+        attrs.remove('co_kwonlyargcount')
+    return types.CodeType(*[changes.get(attr, getattr(code, attr))
+                            for attr in attrs])
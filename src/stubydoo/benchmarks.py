@@ -0,0 +1,439 @@
+"""Microbenchmarks for the stubbing hot paths.
+
+Run them with::
+
+    python -m stubydoo.benchmarks
+
+Each benchmark prints its speed relative to a calibration loop of plain
+Python timed alongside it, the median of ``--repeat`` rounds.  Measured
+that way, results depend much less on how fast or busy the machine is than
+operations per second do, but they still differ between interpreters, and
+on a busy machine some moved by up to a third from run to run, hence the
+wide default ``--tolerance``.
+
+Results can be written as JSON with ``--output`` and compared against a
+baseline with ``--baseline``; the exit status is non-zero when any
+benchmark got slower than the baseline by more than ``--tolerance``.
+``--save-baseline`` stores the current results as the new baseline.  The
+baseline shipped with the package was taken on one machine, and is meant
+to spot large slowdowns of a change, measured before and after it on the
+same machine, rather than to gate releases.
+"""
+import gc
+import json
+import pickle
+import optparse
+import os
+import platform
+import sys
+import timeit
+
+import stubydoo
+
+default_baseline = os.path.join(os.path.dirname(__file__),
+                                'benchmark_baseline.json')
+
+benchmarks = []
+
+
+def benchmark(name, number=10000):
+    def decorator(setup):
+        benchmarks.append((name, setup, number))
+        return setup
+    return decorator
+
+
+@benchmark('stub')
+def bench_stub():
+    # Each run stubs a double of its own: stubbing the same one over and
+    # over would pile up the stubs it replaces.
+    def run():
+        stubydoo.stub(stubydoo.double(), 'method').and_return(1)
+    return run
+
+
+@benchmark('stub and unstub')
+def bench_stub_and_unstub():
+    double = stubydoo.double(method=lambda self: 1)
+
+    def run():
+        stubydoo.stub(double.method).and_return(2)
+        stubydoo.unstub(double.method)
+    return run
+
+
+@benchmark('stub many')
+def bench_stub_many():
+    double = stubydoo.double()
+    table = {
+        'first': {'returns': 1},
+        'second': [{'args': (i,), 'returns': i} for i in range(10)],
+    }
+
+    def run():
+        stubydoo.stub_many(double, table)
+    return run
+
+
+@benchmark('expect, call and verify')
+def bench_expect():
+    double = stubydoo.double()
+
+    def run():
+        stubydoo.expect(double, 'method').and_return(1)
+        double.method()
+        stubydoo.assert_expectations()
+    return run
+
+
+@benchmark('ordered protocol')
+def bench_ordered():
+    connection = stubydoo.double()
+
+    def run():
+        for name in ('connect', 'auth', 'query', 'close'):
+            stubydoo.expect(connection, name).ordered
+        connection.connect()
+        connection.auth()
+        connection.query()
+        connection.close()
+        stubydoo.assert_expectations()
+    return run
+
+
+@benchmark('verify 100 instances', number=100)
+def bench_verify_instances():
+    doubles = [stubydoo.double() for i in range(100)]
+
+    def run():
+        for double in doubles:
+            stubydoo.expect(double, 'method')
+            double.method()
+        stubydoo.assert_expectations()
+    return run
+
+
+def _dispatch_setup(variants):
+    def setup():
+        double = stubydoo.double()
+        stubydoo.stub(double, 'method').and_return('fallback')
+        for i in range(variants):
+            stubydoo.stub(double, 'method').with_args(i, foo='bar').\
+                and_return(i)
+        method = double.method
+        arg = variants // 2
+
+        def run():
+            method(arg, foo='bar')
+        return run
+    return setup
+
+
+benchmark('dispatch among 1 variant', number=100000)(_dispatch_setup(1))
+benchmark('dispatch among 10 variants', number=100000)(_dispatch_setup(10))
+benchmark('dispatch among 1000 variants',
+          number=100000)(_dispatch_setup(1000))
+
+
+@benchmark('matching dispatch', number=100000)
+def bench_matching_dispatch():
+    double = stubydoo.double()
+    stubydoo.stub(double, 'method').and_return('fallback')
+    for i in range(10):
+        stubydoo.stub(double, 'method').with_args([i], foo='bar').\
+            and_return(i)
+    method = double.method
+    arg = [9]
+
+    def run():
+        method(arg, foo='bar')
+    return run
+
+
+@benchmark('dispatch among 100 large payloads', number=100)
+def bench_payload_dispatch():
+    double = stubydoo.double()
+    payload = dict(('key%d' % i, i) for i in range(10000))
+    for i in range(100):
+        stubydoo.stub(double, 'method').with_args(dict(payload, variant=i)).\
+            and_return(i)
+    method = double.method
+    arg = dict(payload, variant=50)
+
+    def run():
+        method(arg)
+    return run
+
+
+@benchmark('dispatch among 1000 variants with matchers', number=100000)
+def bench_partial_dispatch():
+    double = stubydoo.double()
+    any_ = stubydoo.any_()
+    for i in range(1000):
+        stubydoo.stub(double, 'method').with_args(i, any_).and_return(i)
+    method = double.method
+
+    def run():
+        method(500, 'value')
+    return run
+
+
+@benchmark('spy call', number=100000)
+def bench_spy():
+    double = stubydoo.double(method=lambda self, value: value)
+    stubydoo.spy(double.method)
+    method = double.method
+
+    def run():
+        method(1)
+    return run
+
+
+class Account(object):
+
+    def deposit(self, amount, note=None):
+        pass
+
+
+@benchmark('double_of construction', number=100000)
+def bench_double_of():
+    def run():
+        stubydoo.double_of(Account, balance=1)
+    return run
+
+
+@benchmark('autospec call', number=100000)
+def bench_autospec():
+    double = stubydoo.double_of(Account)
+    stubydoo.stub(double, 'deposit').and_return(1)
+    method = double.deposit
+
+    def run():
+        method(10, note='x')
+    return run
+
+
+@benchmark('normalized dispatch among 1000 variants', number=100000)
+def bench_normalized_dispatch():
+    account = Account()
+    for i in range(1000):
+        stubydoo.stub(account, 'deposit', normalize=True).\
+            with_args(amount=i).and_return(i)
+    method = account.deposit
+
+    def run():
+        method(500, note=None)
+    return run
+
+
+@benchmark('matches', number=100000)
+def bench_matches():
+    stub = stubydoo.stub(stubydoo.double(), 'method').\
+        with_args('arg', 1, foo='bar')
+    args, kw = ('arg', 1), {'foo': 'bar'}
+
+    def run():
+        stub.matches(args, kw)
+    return run
+
+
+@benchmark('function patch and unpatch')
+def bench_function_patch():
+    a, b = 1, 2
+
+    def function(c):
+        return a + b + c
+
+    def replacement(c):
+        return c
+
+    function_stub = stubydoo.FunctionStub(function)
+
+    def run():
+        function_stub.patch(replacement)
+        function_stub.unpatch()
+    return run
+
+
+@benchmark('double construction', number=100000)
+def bench_double():
+    def run():
+        stubydoo.double(attribute=1)
+    return run
+
+
+@benchmark('double construction with methods', number=100000)
+def bench_double_with_methods():
+    method = lambda self: 1
+
+    def run():
+        stubydoo.double(attribute=1, method=method)
+    return run
+
+
+@benchmark('double construction with inline methods', number=100000)
+def bench_double_with_inline_methods():
+    def run():
+        stubydoo.double(attribute=1, method=lambda self: 1)
+    return run
+
+
+@benchmark('mock construction', number=100000)
+def bench_mock():
+    def run():
+        stubydoo.mock(attribute=1)
+    return run
+
+
+@benchmark('null construction', number=100000)
+def bench_null():
+    def run():
+        stubydoo.null()
+    return run
+
+
+@benchmark('double pickle round trip', number=100000)
+def bench_pickle():
+    double = stubydoo.double(attribute=1)
+
+    def run():
+        pickle.loads(pickle.dumps(double, 2))
+    return run
+
+
+# The calibration loop, timed right before each round of a benchmark so
+# that both see the machine at the same speed.
+def calibration():
+    values = {}
+    for i in range(20):
+        values[i] = len(str(i))
+    return values
+
+
+calibration_number = 2000
+
+
+def speed(run, number):
+    return number / timeit.timeit(run, number=number)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmark(setup, number=10000, repeat=5):
+    run = setup()
+    speeds = []
+    try:
+        for i in range(repeat):
+            # Garbage left by the previous round would slow this one down.
+            gc.collect()
+            calibrated = speed(calibration, calibration_number)
+            speeds.append(speed(run, number) / calibrated)
+    finally:
+        stubydoo.FunctionStub.clear_all()
+        try:
+            stubydoo.assert_expectations()
+        except AssertionError:
+            pass
+    return median(speeds)
+
+
+def run_benchmarks(names=None, scale=1.0, repeat=5):
+    results = {}
+    for name, setup, number in benchmarks:
+        if names and not any(n in name for n in names):
+            continue
+        number = max(1, int(number * scale))
+        results[name] = run_benchmark(setup, number=number, repeat=repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the (name, ratio) pairs of benchmarks slower than baseline.
+
+    The ratio is the current speed divided by the baseline speed.
+    Benchmarks missing from either side are ignored.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            if ratio < 1.0 - tolerance:
+                regressions.append((name, ratio))
+    return regressions
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+    }
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('environment') != environment():
+        print('Warning: the baseline was taken on %(implementation)s '
+              '%(python)s (%(machine)s)' % data['environment'])
+    return data['results']
+
+
+def dump(results, path):
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f,
+                  indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [name ...]')
+    parser.add_option('-o', '--output', help='write results as JSON here')
+    parser.add_option('-b', '--baseline',
+                      help='compare against this baseline (default: %s)' %
+                      default_baseline)
+    parser.add_option('--save-baseline', action='store_true',
+                      help='store the results as the new baseline')
+    parser.add_option('-t', '--tolerance', type='float', default=0.4,
+                      help='allowed slowdown, as a fraction (default: 0.4)')
+    parser.add_option('-s', '--scale', type='float', default=1.0,
+                      help='multiply the iterations of every benchmark')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='rounds of each benchmark (default: 5)')
+    options, names = parser.parse_args(argv)
+
+    baseline_path = options.baseline or default_baseline
+    baseline = {}
+    if os.path.exists(baseline_path) and not options.save_baseline:
+        baseline = load(baseline_path)
+
+    results = run_benchmarks(names, options.scale, options.repeat)
+    for name, setup, number in benchmarks:
+        if name not in results:
+            continue
+        line = '%-44s %10.4g' % (name, results[name])
+        if name in baseline:
+            line += '  %+6.1f%%' % ((results[name] / baseline[name] - 1) * 100)
+        print(line)
+
+    if options.output:
+        dump(results, options.output)
+    if options.save_baseline:
+        dump(results, baseline_path)
+        return 0
+
+    regressions = compare(results, baseline, options.tolerance)
+    for name, ratio in regressions:
+        print('REGRESSION: %s runs at %.0f%% of the baseline speed' %
+              (name, ratio * 100))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
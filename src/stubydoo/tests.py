@@ -1,8 +1,12 @@
-import inspect
 import os
 import doctest
+import gc
+import pickle
 import stubydoo
+import sys
+import threading
 import unittest
+import weakref
 
 
 class TestStubMethod(unittest.TestCase):
@@ -32,7 +36,7 @@ class TestStubMethod(unittest.TestCase):
             test_with_method_defined.__name__ = (test.__name__ +
                                                  '_with_method_defined')
 
-            f_locals = inspect.currentframe(1).f_locals
+            f_locals = sys._getframe(1).f_locals
             f_locals[test_with_method_defined.__name__] = \
                 test_with_method_defined
 
@@ -183,6 +187,343 @@ class TestUnstubbingCallsInExistingMethod(unittest.TestCase):
         self.assertTrue(self.object.method('any args') is value)
 
 
+class TestStubbingManyInstancesOfTheSameClass(unittest.TestCase):
+
+    def setUp(self):
+        class myobject(object):
+            def method(self):
+                return 'original'
+        self.objects = [myobject() for i in range(3)]
+
+    def test_patched_instances_share_their_class(self):
+        for obj in self.objects:
+            stubydoo.stub(obj, 'method')
+        self.assertEquals(len(set(type(obj) for obj in self.objects)), 1)
+
+    def test_each_instance_sees_its_own_stubs(self):
+        first, second, third = self.objects
+        stubydoo.stub(first.method).and_return('first')
+        stubydoo.stub(second.method).and_return('second')
+        stubydoo.stub(second, 'other_method').and_return('other')
+        self.assertEquals(first.method(), 'first')
+        self.assertEquals(second.method(), 'second')
+        self.assertEquals(third.method(), 'original')
+        self.assertEquals(second.other_method(), 'other')
+        self.assertRaises(AttributeError, getattr, first, 'other_method')
+
+    def test_unstubbing_one_instance_keeps_the_others_stubbed(self):
+        first, second, third = self.objects
+        stubydoo.stub(first.method).and_return('first')
+        stubydoo.stub(second.method).and_return('second')
+        stubydoo.unstub(first.method)
+        self.assertEquals(first.method(), 'original')
+        self.assertEquals(second.method(), 'second')
+        self.assertTrue(type(first) is type(third))
+
+    def test_special_methods_are_kept_to_their_instance(self):
+        first, second = stubydoo.double(), stubydoo.double()
+        stubydoo.stub(first, '__len__').and_return(0)
+        stubydoo.stub(first, '__call__').and_return('called')
+        stubydoo.stub(second, 'other').and_return('other')
+        self.assertEquals(len(first), 0)
+        self.assertFalse(first)
+        self.assertEquals(first(), 'called')
+        self.assertTrue(second)
+        self.assertFalse(callable(second))
+        self.assertRaises(TypeError, len, second)
+        self.assertEquals(second.other(), 'other')
+
+    def test_calling_original_next_to_special_methods(self):
+        first = self.objects[0]
+        stubydoo.stub(first, '__len__').and_return(0)
+        stubydoo.stub(first, 'method').and_call_original()
+        self.assertEquals(first.method(), 'original')
+        stubydoo.unstub(first.method)
+        self.assertEquals(len(first), 0)
+
+
+class TestCompactStubs(unittest.TestCase):
+
+    def setUp(self):
+        self.double = stubydoo.double()
+
+    def test_stubs_have_no_instance_dictionary(self):
+        for stub in (stubydoo.stub(self.double, 'method'),
+                     stubydoo.expect(self.double, 'other'),
+                     stubydoo.stub(self.double, 'method').arguments,
+                     self.double._expectations_['method']):
+            self.assertFalse(hasattr(stub, '__dict__'))
+        self.double.other()
+        stubydoo.assert_expectations()
+
+    def test_stubs_without_arguments_share_them(self):
+        first = stubydoo.stub(self.double, 'method')
+        second = stubydoo.stub(self.double, 'other')
+        self.assertTrue(first.arguments is second.arguments)
+
+    def test_setting_keyword_arguments_does_not_change_shared_ones(self):
+        first = stubydoo.stub(self.double, 'method').\
+            with_kwargs({'a': 1}).and_return(1)
+        second = stubydoo.stub(self.double, 'other').and_return(2)
+        self.assertEquals(second.arguments.kwargs, {})
+        self.assertEquals(self.double.method(a=1), 1)
+        self.assertEquals(self.double.other(), 2)
+        self.assertEquals(first.output(a=1), 1)
+
+
+class TestStubMany(unittest.TestCase):
+
+    def setUp(self):
+        class myobject(object):
+            def get(self):
+                return 'original'
+        self.object = myobject()
+
+    def test_stubbing_many_methods(self):
+        stubydoo.stub_many(self.object, {
+            'get': {'returns': 'value'},
+            'find': [{'args': (1,), 'returns': 'one'},
+                     {'args': (2,), 'kwargs': {'deep': True},
+                      'returns': 'two'},
+                     {'returns': 'fallback'}],
+            'fail': {'raises': KeyError},
+            'iterate': {'yields': (1, 2)},
+            'compute': {'runs': lambda a, b: a + b},
+        })
+        self.assertEquals(self.object.get(), 'value')
+        self.assertEquals(self.object.find(1), 'one')
+        self.assertEquals(self.object.find(2, deep=True), 'two')
+        self.assertEquals(self.object.find(3), 'fallback')
+        self.assertRaises(KeyError, self.object.fail)
+        self.assertEquals(list(self.object.iterate()), [1, 2])
+        self.assertEquals(self.object.compute(1, 2), 3)
+
+    def test_installed_stubs_are_returned(self):
+        installed = stubydoo.stub_many(self.object, {
+            'get': {'returns': 'value'},
+            'find': [{'args': (1,)}, {'args': (2,)}],
+        })
+        self.assertTrue(isinstance(installed['get'], stubydoo.MethodStub))
+        self.assertEquals(len(installed['find']), 2)
+        installed['get'].unset()
+        self.assertRaises(stubydoo.UnexpectedCallError, self.object.get)
+
+    def test_unknown_keys_are_rejected(self):
+        self.assertRaises(TypeError, stubydoo.stub_many, self.object,
+                          {'get': {'return': 'value'}})
+        self.assertRaises(TypeError, stubydoo.stub_many, self.object,
+                          {'get': {'times': 1}})
+
+    def test_specs_with_more_than_one_output_are_rejected(self):
+        self.assertRaises(TypeError, stubydoo.stub_many, self.object,
+                          {'get': {'returns': 1, 'runs': lambda: 2}})
+        self.assertRaises(TypeError, stubydoo.expect_many, self.object,
+                          {'get': {'raises': ValueError, 'yields': [1]}})
+
+    def test_expecting_many_methods(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect_many(self.object, {
+                'get': {'returns': 'value', 'times': 2},
+                'find': [{'args': (1,), 'at_least': 1},
+                         {'args': (2,), 'times': 0}],
+            })
+            self.object.get()
+            self.object.get()
+            self.object.find(1)
+        test()
+
+    def test_unmet_expectations_from_table_fail(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect_many(self.object, {
+                'get': {'returns': 'value', 'times': 2},
+            })
+            self.object.get()
+        self.assertRaises(stubydoo.ExpectationNotSatisfiedError, test)
+
+
+class Account(object):
+
+    def deposit(self, amount, note=None):
+        pass
+
+    def transfer(self, other, *amounts, **options):
+        pass
+
+    @staticmethod
+    def parse(text):
+        pass
+
+    @classmethod
+    def open(cls, owner):
+        pass
+
+
+class TestAutospec(unittest.TestCase):
+
+    def setUp(self):
+        self.account = Account()
+
+    def tearDown(self):
+        try:
+            stubydoo.assert_expectations()
+        except AssertionError:
+            pass
+
+    def test_methods_called_as_the_real_ones(self):
+        stubydoo.stub(self.account, 'deposit', autospec=True).\
+            and_return('deposited')
+        self.assertEquals(self.account.deposit(10), 'deposited')
+        self.assertEquals(self.account.deposit(10, note='x'), 'deposited')
+        self.assertEquals(self.account.deposit(amount=10), 'deposited')
+
+    def test_calls_the_real_method_would_refuse(self):
+        stubydoo.stub(self.account.deposit, autospec=True)
+        self.assertRaises(TypeError, self.account.deposit)
+        self.assertRaises(TypeError, self.account.deposit, 1, 2, 3)
+        self.assertRaises(TypeError, self.account.deposit, 1, amount=1)
+        self.assertRaises(TypeError, self.account.deposit, 1, memo='x')
+
+    def test_variable_arguments(self):
+        stubydoo.stub(self.account, 'transfer', autospec=True)
+        self.account.transfer('other', 1, 2, 3, fee=1)
+        self.assertRaises(TypeError, self.account.transfer)
+
+    def test_static_and_class_methods(self):
+        stubydoo.stub(self.account, 'parse', autospec=True)
+        stubydoo.stub(self.account, 'open', autospec=True)
+        self.account.parse('text')
+        self.account.open('owner')
+        self.assertRaises(TypeError, self.account.parse)
+        self.assertRaises(TypeError, self.account.open, 'owner', 'other')
+
+    def test_missing_methods(self):
+        self.assertRaises(AttributeError, stubydoo.stub, self.account,
+                          'withdraw', autospec=True)
+        self.assertFalse(hasattr(self.account, '_expectations_'))
+
+    def test_expected_arguments_are_checked(self):
+        expectation = stubydoo.expect(self.account, 'deposit', autospec=True)
+        self.assertRaises(TypeError, expectation.with_args, 1, 2, 3)
+        self.assertRaises(TypeError, expectation.with_kwargs, {'memo': 1})
+        expectation.with_args(1, note='x')
+
+    def test_signatures_are_worked_out_once(self):
+        self.assertTrue(stubydoo._binding_plan(Account, 'deposit') is
+                        stubydoo._binding_plan(Account, 'deposit'))
+
+    def test_double_of_a_class(self):
+        double = stubydoo.double_of(Account, balance=10)
+        self.assertEquals(double.balance, 10)
+        stubydoo.stub(double, 'deposit').and_return('deposited')
+        self.assertEquals(double.deposit(10), 'deposited')
+        self.assertRaises(TypeError, double.deposit)
+        self.assertRaises(AttributeError, stubydoo.stub, double, 'withdraw')
+
+    def test_double_of_a_class_with_methods(self):
+        double = stubydoo.double_of(Account, deposit=lambda self, a: a)
+        self.assertEquals(double.deposit(10), 10)
+        self.assertRaises(AttributeError, stubydoo.double_of, Account,
+                          withdraw=lambda self: None)
+
+    def test_double_of_a_class_with_many_stubs(self):
+        double = stubydoo.double_of(Account)
+        stubydoo.stub_many(double, {'deposit': {'args': (1,)}})
+        self.assertRaises(AttributeError, stubydoo.stub_many, double,
+                          {'withdraw': {}})
+        self.assertRaises(TypeError, stubydoo.stub_many, double,
+                          {'deposit': {'args': (1, 2, 3)}})
+
+
+class TestNormalizedArguments(unittest.TestCase):
+
+    def setUp(self):
+        self.account = Account()
+
+    def tearDown(self):
+        try:
+            stubydoo.assert_expectations()
+        except AssertionError:
+            pass
+
+    def stub(self, method_name='deposit'):
+        return stubydoo.stub(self.account, method_name, normalize=True)
+
+    def test_arguments_by_name_match_arguments_by_position(self):
+        self.stub().with_args(1, note='x').and_return('deposited')
+        self.assertEquals(self.account.deposit(1, 'x'), 'deposited')
+        self.assertEquals(self.account.deposit(amount=1, note='x'),
+                          'deposited')
+
+    def test_defaults_match_missing_arguments(self):
+        self.stub().with_args(1).and_return('deposited')
+        self.assertEquals(self.account.deposit(1, None), 'deposited')
+        self.assertEquals(self.account.deposit(amount=1), 'deposited')
+
+    def test_different_arguments_do_not_match(self):
+        self.stub().and_return('fallback')
+        self.stub().with_args(amount=1).and_return('deposited')
+        self.assertEquals(self.account.deposit(1, 'x'), 'fallback')
+
+    def test_normalized_arguments_are_indexed(self):
+        for i in range(10):
+            self.stub().with_args(amount=i).and_return(i)
+        self.assertEquals(len(self.account._expectations_['deposit'].
+                              _positional_index), 10)
+        self.assertEquals(self.account.deposit(7), 7)
+
+    def test_equivalent_arguments_replace_the_stub(self):
+        self.stub().with_args(1).and_return('first')
+        self.stub().with_args(amount=1, note=None).and_return('second')
+        self.assertEquals(
+            len(self.account._expectations_['deposit'].
+                expectations_with_arguments), 1
+        )
+        self.assertEquals(self.account.deposit(1), 'second')
+
+    def test_stubs_set_before_are_normalized(self):
+        stubydoo.stub(self.account, 'deposit').with_args(amount=1).\
+            and_return('first')
+        self.stub().with_args(2).and_return('second')
+        self.assertEquals(self.account.deposit(1), 'first')
+        self.assertEquals(self.account.deposit(note=None, amount=2),
+                          'second')
+
+    def test_keyword_arguments_given_later(self):
+        self.stub().with_args(1).with_kwargs({'note': 'x'}).\
+            and_return('deposited')
+        self.assertEquals(self.account.deposit(1, note='x'), 'deposited')
+
+    def test_variable_arguments(self):
+        self.stub('transfer').with_args('other', 1, 2, fee=1).\
+            and_return('transferred')
+        self.assertEquals(self.account.transfer('other', 1, 2, fee=1),
+                          'transferred')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.account.transfer, 'other', 1, fee=1)
+
+    def test_calls_the_real_method_would_refuse(self):
+        self.stub().with_args(1)
+        self.assertRaises(TypeError, self.account.deposit, 1, amount=1)
+
+    def test_functions_get_the_arguments_as_given(self):
+        received = []
+        self.stub().with_args(1).and_run(
+            lambda *args, **kw: received.append((args, kw))
+        )
+        self.account.deposit(amount=1)
+        self.assertEquals(received, [((), {'amount': 1})])
+
+    def test_expectations(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.account, 'deposit', normalize=True).\
+                with_args(1, note=None).once
+            self.account.deposit(amount=1)
+        test()
+
+
 class TestStubAttributes(unittest.TestCase):
 
     def setUp(self):
@@ -360,6 +701,356 @@ class TestArgumentMatching(unittest.TestCase):
         self.assertEquals(returned_value, 'not matched')
 
 
+class TestManyArgumentVariants(unittest.TestCase):
+
+    def setUp(self):
+        class AnythingMatcher(object):
+            def __eq__(self, other):
+                return True
+
+        class AboveMatcher(object):
+            def __init__(self, limit):
+                self.limit = limit
+
+            def __eq__(self, other):
+                return isinstance(other, int) and other > self.limit
+
+        self.double = stubydoo.double()
+        self.anything = AnythingMatcher
+        self.above = AboveMatcher
+
+    def test_each_variant_returns_its_own_value(self):
+        for i in range(1000):
+            stubydoo.stub(self.double, 'method').with_args(i, key=str(i)).\
+                and_return(i * 2)
+        self.assertEquals(self.double.method(10, key='10'), 20)
+        self.assertEquals(self.double.method(999, key='999'), 1998)
+
+    def test_variant_with_same_arguments_replaces_previous_one(self):
+        stubydoo.stub(self.double, 'method').with_args(1).and_return('old')
+        stubydoo.stub(self.double, 'method').with_args(1).and_return('new')
+        self.assertEquals(self.double.method(1), 'new')
+
+    def test_equal_but_different_typed_arguments_match(self):
+        stubydoo.stub(self.double, 'method').with_args(1).and_return('one')
+        self.assertEquals(self.double.method(1.0), 'one')
+
+    def test_unhashable_arguments_match(self):
+        stubydoo.stub(self.double, 'method').with_args([1]).and_return('list')
+        stubydoo.stub(self.double, 'method').with_args(1).and_return('one')
+        self.assertEquals(self.double.method([1]), 'list')
+        self.assertEquals(self.double.method(1), 'one')
+
+    def test_exact_variant_replaces_matcher_it_is_equal_to(self):
+        stubydoo.stub(self.double, 'method').with_args(self.anything()).\
+            and_return('matcher')
+        stubydoo.stub(self.double, 'method').with_args(1).and_return('one')
+        self.assertEquals(self.double.method(1), 'one')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 2)
+
+    def test_exact_variants_and_matchers_coexist(self):
+        stubydoo.stub(self.double, 'method').with_args(1).and_return('one')
+        stubydoo.stub(self.double, 'method').with_args(self.above(5)).\
+            and_return('matcher')
+        self.assertEquals(self.double.method(1), 'one')
+        self.assertEquals(self.double.method(7), 'matcher')
+
+    def test_matcher_in_call_matches_exact_expectation(self):
+        stubydoo.stub(self.double, 'method').with_args(1).and_return('one')
+        self.assertEquals(self.double.method(self.anything()), 'one')
+
+    def test_unset_variant_falls_back(self):
+        stubydoo.stub(self.double, 'method').and_return('fallback')
+        specific = stubydoo.stub(self.double, 'method').with_args(1).\
+            and_return('one')
+        specific.unset()
+        self.assertEquals(self.double.method(1), 'fallback')
+
+
+class Array(object):
+    # Quacks like a NumPy array, equality included.
+    shape = dtype = None
+
+    def __init__(self, values, dtype='int64'):
+        self.values = list(values)
+        self.shape = (len(self.values),)
+        self.dtype = dtype
+
+    def tobytes(self):
+        return repr(self.values).encode('ascii')
+
+    def __eq__(self, other):
+        raise ValueError('The truth value of an array is ambiguous')
+
+    __hash__ = None
+
+
+class TestLargePayloads(unittest.TestCase):
+
+    def setUp(self):
+        self.double = stubydoo.double()
+        stubydoo.stub(self.double, 'method').and_return('fallback')
+        self.payload = dict(('key%d' % i, [i]) for i in range(1000))
+
+    def stub_variants(self, count):
+        for i in range(count):
+            stubydoo.stub(self.double, 'method').\
+                with_args(dict(self.payload, variant=i)).and_return(i)
+
+    def test_equal_payloads_match(self):
+        for count in (2, 10):
+            self.stub_variants(count)
+            payload = dict(self.payload, variant=1)
+            reordered = dict(reversed(list(payload.items())))
+            self.assertEquals(self.double.method(payload), 1)
+            self.assertEquals(self.double.method(reordered), 1)
+            self.assertEquals(self.double.method(self.payload), 'fallback')
+
+    def test_the_very_same_payload_matches(self):
+        payload = dict(self.payload)
+        stubydoo.stub(self.double, 'method').with_args(payload).\
+            and_return('same')
+        self.stub_variants(10)
+        payload['changed'] = True
+        self.assertEquals(self.double.method(payload), 'same')
+
+    def test_payloads_among_other_arguments(self):
+        for i in range(10):
+            stubydoo.stub(self.double, 'method').\
+                with_args(i, [i] * 100, key={'set': set([i])}).and_return(i)
+        self.assertEquals(
+            self.double.method(5, [5] * 100, key={'set': frozenset([5])}), 5
+        )
+        self.assertEquals(
+            self.double.method(5, [5] * 100, key={'set': set([6])}),
+            'fallback'
+        )
+
+    def test_arrays_match_by_shape_type_and_contents(self):
+        for count in (2, 10):
+            for i in range(count):
+                stubydoo.stub(self.double, 'method').\
+                    with_args(Array(range(i + 1))).and_return(i)
+            self.assertEquals(self.double.method(Array(range(2))), 1)
+            self.assertEquals(
+                self.double.method(Array(range(2), dtype='float64')),
+                'fallback'
+            )
+            self.assertEquals(self.double.method([0, 1]), 'fallback')
+
+    def test_equal_arrays_replace_the_stub(self):
+        stubydoo.stub(self.double, 'method').with_args(Array([1])).\
+            and_return('first')
+        stubydoo.stub(self.double, 'method').with_args(Array([1])).\
+            and_return('second')
+        self.assertEquals(self.double.method(Array([1])), 'second')
+
+    def test_arrays_with_matchers(self):
+        stubydoo.stub(self.double, 'method').\
+            with_args(Array([1]), stubydoo.any_()).and_return('matched')
+        self.assertEquals(self.double.method(Array([1]), 2), 'matched')
+
+    def test_payloads_which_cant_be_digested(self):
+        class Anything(object):
+            __hash__ = None
+
+            def __eq__(self, other):
+                return True
+        self.stub_variants(10)
+        stubydoo.stub(self.double, 'method').with_args([Anything()]).\
+            and_return('anything')
+        self.assertEquals(self.double.method([1]), 'anything')
+        self.assertEquals(self.double.method([Anything()]), 'anything')
+
+    def test_payloads_holding_hashable_arbitrary_objects(self):
+        class Anything(object):
+            def __hash__(self):
+                return 0
+
+            def __eq__(self, other):
+                return True
+        numbers = list(range(100))
+        for i in range(6):
+            stubydoo.stub(self.double, 'method').with_args(numbers + [i]).\
+                and_return(i)
+        stubydoo.stub(self.double, 'method').\
+            with_args(numbers + [Anything()]).and_return('anything')
+        self.assertEquals(self.double.method(numbers + [42]), 'anything')
+        self.assertEquals(self.double.method(numbers + [1]), 'anything')
+
+    def test_equal_arbitrary_objects_are_replaced(self):
+        class Anything(object):
+            __hash__ = None
+
+            def __eq__(self, other):
+                return True
+        stubydoo.stub(self.double, 'method').with_args(Anything()).\
+            and_return('anything')
+        self.stub_variants(10)
+        method_expectations = self.double._expectations_['method']
+        self.assertEquals(len(method_expectations._unindexed), 0)
+        self.assertEquals(
+            self.double.method(dict(self.payload, variant=1)), 1
+        )
+        self.assertEquals(self.double.method(Anything()), 0)
+
+    def test_digests_are_forgotten_with_the_stubs(self):
+        method_expectations = self.double._expectations_['method']
+        with stubydoo.scope():
+            self.stub_variants(10)
+            self.assertEquals(len(method_expectations._payload_digests), 10)
+        self.assertEquals(len(method_expectations._payload_digests), 0)
+        self.assertEquals(self.double.method(self.payload), 'fallback')
+
+
+class TestMatchers(unittest.TestCase):
+
+    def setUp(self):
+        self.double = stubydoo.double()
+
+    def stub(self, *args, **kw):
+        return stubydoo.stub(self.double, 'method').with_args(*args, **kw)
+
+    def test_any(self):
+        self.stub(stubydoo.any_()).and_return('any')
+        self.assertEquals(self.double.method(object()), 'any')
+        self.assertRaises(stubydoo.UnexpectedCallError, self.double.method)
+
+    def test_instance_of(self):
+        self.stub(stubydoo.instance_of(int, float)).and_return('number')
+        self.assertEquals(self.double.method(1), 'number')
+        self.assertEquals(self.double.method(1.5), 'number')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, '1')
+
+    def test_contains(self):
+        self.stub(stubydoo.contains(1, 2)).and_return('contains')
+        self.assertEquals(self.double.method([3, 2, 1]), 'contains')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, [1])
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 1)
+
+    def test_dict_including(self):
+        self.stub(stubydoo.dict_including({'a': 1}, b=2)).and_return('dict')
+        self.assertEquals(self.double.method({'a': 1, 'b': 2, 'c': 3}),
+                          'dict')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, {'a': 1})
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, [1, 2])
+
+    def test_regex(self):
+        self.stub(stubydoo.regex(r'^ab+c$')).and_return('regex')
+        self.assertEquals(self.double.method('abbc'), 'regex')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 'ac')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 1)
+
+    def test_satisfying(self):
+        self.stub(stubydoo.satisfying(lambda value: value > 5)).\
+            and_return('above')
+        self.assertEquals(self.double.method(6), 'above')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 5)
+
+    def test_matchers_in_keyword_arguments(self):
+        self.stub(1, key=stubydoo.instance_of(str)).and_return('keyword')
+        self.assertEquals(self.double.method(1, key='value'), 'keyword')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 1, key=2)
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 1)
+
+    def test_nested_matchers(self):
+        self.stub([stubydoo.any_(), 2],
+                  stubydoo.dict_including(key=stubydoo.regex('^v'))).\
+            and_return('nested')
+        self.assertEquals(self.double.method([1, 2], {'key': 'value'}),
+                          'nested')
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, [1, 2], {'key': 'other'})
+
+    def test_matchers_as_keyword_arguments(self):
+        stubydoo.stub(self.double, 'method').\
+            with_kwargs(stubydoo.dict_including(key=1)).and_return('kwargs')
+        self.assertEquals(self.double.method(key=1, other=2), 'kwargs')
+
+    def test_exact_variant_does_not_replace_matcher(self):
+        self.stub(stubydoo.any_()).and_return('any')
+        self.stub(1).and_return('one')
+        self.assertEquals(self.double.method(1), 'any')
+        self.assertEquals(self.double.method(2), 'any')
+
+    def test_variant_with_same_matchers_replaces_previous_one(self):
+        self.stub(1, stubydoo.instance_of(int)).and_return('old')
+        self.stub(stubydoo.any_()).and_return('any')
+        self.stub(1, stubydoo.instance_of(int)).and_return('new')
+        self.assertEquals(self.double.method(1, 2), 'new')
+        self.assertEquals(
+            len(self.double._expectations_['method']
+                .expectations_with_arguments), 2
+        )
+
+    def test_first_matching_variant_wins(self):
+        self.stub(1, stubydoo.instance_of(str)).and_return('first')
+        self.stub(stubydoo.any_(), stubydoo.any_()).and_return('second')
+        self.stub(1, stubydoo.any_()).and_return('third')
+        self.stub(2, stubydoo.any_()).and_return('fourth')
+        self.assertEquals(self.double.method(1, 'a'), 'first')
+        self.assertEquals(self.double.method(1, 2), 'second')
+        self.assertEquals(self.double.method(2, 2), 'second')
+
+    def test_exact_variant_set_first_wins_over_matchers(self):
+        self.stub(1, 2).and_return('exact')
+        self.stub(1, stubydoo.any_()).and_return('matcher')
+        self.assertEquals(self.double.method(1, 2), 'exact')
+        self.assertEquals(self.double.method(1, 3), 'matcher')
+
+    def test_arbitrary_objects_in_calls_are_tried_against_all_variants(self):
+        class Anything(object):
+            def __eq__(self, other):
+                return True
+        self.stub(1, stubydoo.any_()).and_return('one')
+        self.assertEquals(self.double.method(Anything(), 2), 'one')
+
+    def test_unset_variant_with_matchers(self):
+        self.stub(stubydoo.any_()).and_return('any')
+        specific = self.stub(1, stubydoo.any_()).and_return('specific')
+        self.assertEquals(self.double.method(1, 1), 'specific')
+        specific.unset()
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 1, 1)
+        self.assertEquals(self.double.method(1), 'any')
+
+    def test_only_variants_with_the_same_plain_values_are_tried(self):
+        checked = []
+
+        def check(value):
+            checked.append(value)
+            return True
+        for i in range(1000):
+            self.stub(i, stubydoo.satisfying(check)).and_return(i)
+        self.assertEquals(self.double.method(500, 'x'), 500)
+        self.assertEquals(checked, ['x'])
+
+    def test_variants_indexed_under_keyword_arguments(self):
+        for i in range(100):
+            self.stub(stubydoo.any_(), key=i).and_return(i)
+        self.assertEquals(self.double.method(None, key=50), 50)
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, None, key=100)
+
+    def test_matchers_compare_by_kind_and_expected_values(self):
+        self.assertEquals(stubydoo.instance_of(int), stubydoo.instance_of(int))
+        self.assertNotEquals(stubydoo.instance_of(int),
+                             stubydoo.instance_of(str))
+        self.assertNotEquals(stubydoo.any_(), stubydoo.instance_of(int))
+        self.assertEquals(stubydoo.regex('a'), stubydoo.regex('a'))
+
+
 class TestStubException(unittest.TestCase):
 
     def setUp(self):
@@ -373,7 +1064,7 @@ class TestStubException(unittest.TestCase):
         self.assertRaises(self.error, self.double.method)
 
     def test_with_arguments(self):
-        stubydoo.stub(self.double, 'method').and_raise(StandardError)
+        stubydoo.stub(self.double, 'method').and_raise(Exception)
         stubydoo.stub(self.double, 'method').with_args(1).and_raise(self.error)
         self.assertRaises(self.error, self.double.method, 1)
 
@@ -416,6 +1107,78 @@ class TestStubUsingCustomFunctionAsReturningValue(unittest.TestCase):
                           (('a', 'b'), {'a': 'a', 'b': 'b'}))
 
 
+class TestReturnSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.double = stubydoo.double()
+        self.stub = stubydoo.stub(self.double, 'method')
+
+    def calls(self, number):
+        return [self.double.method() for i in range(number)]
+
+    def test_values_are_returned_in_sequence(self):
+        self.stub.and_return_sequence([1, 2, 3])
+        self.assertEquals(self.calls(3), [1, 2, 3])
+        self.assertRaises(stubydoo.SequenceExhaustedError, self.double.method)
+
+    def test_exhaustion_is_an_unexpected_call(self):
+        self.stub.and_return_sequence([])
+        self.assertRaises(stubydoo.UnexpectedCallError, self.double.method)
+
+    def test_repeating_the_last_value(self):
+        self.stub.and_return_sequence([1, 2], on_exhaustion='repeat')
+        self.assertEquals(self.calls(4), [1, 2, 2, 2])
+
+    def test_cycling(self):
+        self.stub.and_return_sequence([1, 2], on_exhaustion='cycle')
+        self.assertEquals(self.calls(5), [1, 2, 1, 2, 1])
+
+    def test_cycling_over_an_iterator(self):
+        self.stub.and_return_sequence(iter([1, 2]), on_exhaustion='cycle')
+        self.assertEquals(self.calls(5), [1, 2, 1, 2, 1])
+
+    def test_values_are_pulled_lazily(self):
+        pulled = []
+
+        def generator():
+            i = 0
+            while True:
+                pulled.append(i)
+                yield i
+                i += 1
+        self.stub.and_return_from(generator())
+        self.assertEquals(self.calls(3), [0, 1, 2])
+        self.assertEquals(pulled, [0, 1, 2])
+
+    def test_cycling_restarts_generator_functions(self):
+        def generator():
+            yield 1
+            yield 2
+        self.stub.and_return_from(generator, on_exhaustion='cycle')
+        self.assertEquals(self.calls(5), [1, 2, 1, 2, 1])
+
+    def test_unknown_exhaustion_mode(self):
+        self.assertRaises(ValueError, self.stub.and_return_sequence, [1],
+                          on_exhaustion='stop')
+
+    def test_sequences_with_arguments(self):
+        self.stub.and_return('other')
+        stubydoo.stub(self.double, 'method').with_args(1).\
+            and_return_sequence('ab')
+        self.assertEquals(self.double.method(1), 'a')
+        self.assertEquals(self.double.method(2), 'other')
+        self.assertEquals(self.double.method(1), 'b')
+
+    def test_expected_calls_are_counted(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'other').twice.\
+                and_return_sequence([1, 2])
+            self.assertEquals([self.double.other(), self.double.other()],
+                              [1, 2])
+        test()
+
+
 class TestStubIterator(unittest.TestCase):
 
     def setUp(self):
@@ -802,6 +1565,237 @@ class TestExpectations(unittest.TestCase):
         self.assertRaises(stubydoo.ExpectationNotSatisfiedError, exceeded)
 
 
+class TestOrderedExpectations(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = stubydoo.double()
+        self.cursor = stubydoo.double()
+
+    def tearDown(self):
+        try:
+            stubydoo.assert_expectations()
+        except AssertionError:
+            pass
+
+    def expect_protocol(self):
+        stubydoo.expect(self.connection, 'connect').ordered
+        stubydoo.expect(self.connection, 'auth').ordered
+        stubydoo.expect(self.cursor, 'query').at_least(1).ordered
+        stubydoo.expect(self.connection, 'close').ordered
+
+    def test_calls_in_order(self):
+        @stubydoo.assert_expectations
+        def test():
+            self.expect_protocol()
+            self.connection.connect()
+            self.connection.auth()
+            self.cursor.query()
+            self.cursor.query()
+            self.connection.close()
+        test()
+
+    def test_call_out_of_order(self):
+        self.expect_protocol()
+        self.connection.connect()
+        try:
+            self.cursor.query()
+        except stubydoo.OrderViolationError:
+            error = sys.exc_info()[1]
+        else:
+            self.fail('OrderViolationError not raised')
+        self.assertEquals(error.expected.method_name, 'auth')
+        self.assertEquals(error.actual.method_name, 'query')
+        self.assertTrue('#2' in str(error) and '#3' in str(error))
+
+    def test_call_to_an_earlier_expectation(self):
+        stubydoo.expect(self.connection, 'connect').ordered.\
+            any_number_of_times
+        stubydoo.expect(self.connection, 'close').ordered
+        self.connection.connect()
+        self.connection.close()
+        self.assertRaises(stubydoo.OrderViolationError,
+                          self.connection.connect)
+
+    def test_violations_are_assertion_errors(self):
+        self.assertTrue(issubclass(stubydoo.OrderViolationError,
+                                   AssertionError))
+
+    def test_unordered_expectations_are_not_checked(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.connection, 'connect').ordered
+            stubydoo.expect(self.connection, 'ping')
+            stubydoo.expect(self.connection, 'close').ordered
+            self.connection.connect()
+            self.connection.ping()
+            self.connection.close()
+        test()
+
+    def test_replaced_expectations_leave_the_sequence(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.connection, 'connect').with_args(1).ordered
+            stubydoo.expect(self.connection, 'connect').with_args(1).ordered
+            stubydoo.expect(self.connection, 'close').ordered
+            self.connection.connect(1)
+            self.connection.close()
+        test()
+
+    def test_withdrawn_expectations_leave_the_sequence(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.connection, 'connect').ordered
+            with stubydoo.scope():
+                stubydoo.expect(self.connection, 'auth').ordered
+                self.connection.connect()
+                self.connection.auth()
+            stubydoo.expect(self.cursor, 'query').ordered
+            stubydoo.unstub(self.cursor.query)
+            stubydoo.expect(self.connection, 'close').ordered
+            self.connection.close()
+        test()
+
+    def test_expectations_given_back_take_their_place_again(self):
+        stubydoo.expect(self.connection, 'connect').with_args(1).ordered
+        with stubydoo.scope():
+            stubydoo.expect(self.connection, 'connect').with_args(1).\
+                to_not_be_called
+        stubydoo.expect(self.connection, 'close').ordered
+        self.assertRaises(stubydoo.OrderViolationError,
+                          self.connection.close)
+
+    def test_sequence_starts_over_after_verification(self):
+        for i in range(2):
+            @stubydoo.assert_expectations
+            def test():
+                self.expect_protocol()
+                self.connection.connect()
+                self.connection.auth()
+                self.cursor.query()
+                self.connection.close()
+            test()
+
+
+class TestSpies(unittest.TestCase):
+
+    def setUp(self):
+        class Calculator(object):
+            def __init__(self):
+                self.additions = 0
+
+            def add(self, a, b=0):
+                self.additions += 1
+                return a + b
+
+            def fail(self):
+                raise ValueError
+        self.calculator = Calculator()
+
+    def tearDown(self):
+        try:
+            stubydoo.assert_expectations()
+        except AssertionError:
+            pass
+
+    def test_spy_calls_the_original_method(self):
+        spy = stubydoo.spy(self.calculator.add)
+        self.assertEquals(self.calculator.add(1, b=2), 3)
+        self.assertEquals(self.calculator.add(3), 3)
+        self.assertEquals(spy.calls, 2)
+        self.assertEquals(self.calculator.additions, 2)
+
+    def test_spy_is_satisfied_without_calls(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.spy(self.calculator, 'add')
+        test()
+
+    def test_spy_can_expect_a_number_of_calls(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.spy(self.calculator.add).twice
+            self.calculator.add(1)
+        self.assertRaises(stubydoo.ExpectationNotSatisfiedError, test)
+
+    def test_spy_can_check_arguments(self):
+        stubydoo.spy(self.calculator.add).with_args(1, 2)
+        self.assertEquals(self.calculator.add(1, 2), 3)
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.calculator.add, 2, 2)
+
+    def test_errors_of_the_original_method_are_raised(self):
+        stubydoo.spy(self.calculator.fail)
+        self.assertRaises(ValueError, self.calculator.fail)
+
+    def test_spy_is_removed_when_verified(self):
+        stubydoo.spy(self.calculator.add)
+        stubydoo.assert_expectations()
+        self.assertEquals(self.calculator.add(1, 1), 2)
+        self.assertFalse(hasattr(self.calculator, '_expectations_'))
+
+    def test_calling_original_for_some_arguments(self):
+        stubydoo.stub(self.calculator.add).and_return('stubbed')
+        stubydoo.stub(self.calculator.add).with_args(1, 1).\
+            and_call_original()
+        self.assertEquals(self.calculator.add(1, 1), 2)
+        self.assertEquals(self.calculator.add(2, 2), 'stubbed')
+
+    def test_missing_original_method(self):
+        self.assertRaises(AttributeError, stubydoo.spy, self.calculator,
+                          'subtract')
+
+
+class TestExpectationsTracking(unittest.TestCase):
+
+    def setUp(self):
+        self.double = stubydoo.double()
+
+    def test_replaced_expectation_is_not_verified(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method').with_args(1)
+            stubydoo.expect(self.double, 'method').with_args(1).\
+                to_not_be_called
+        test()
+
+    def test_unstubbed_expectation_is_not_verified(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method')
+            stubydoo.unstub(self.double.method)
+        test()
+
+    def test_unset_expectation_is_not_verified(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method').unset()
+        test()
+
+    def test_error_names_unsatisfied_expectations(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method')
+            stubydoo.expect(self.double, 'other_method')
+            self.double.method()
+        try:
+            test()
+        except stubydoo.ExpectationNotSatisfiedError as exc:
+            self.assertTrue("'other_method'" in str(exc))
+            self.assertFalse("'method'" in str(exc))
+        else:
+            self.fail()
+
+    def test_many_satisfied_expectations(self):
+        doubles = [stubydoo.double() for i in range(100)]
+
+        @stubydoo.assert_expectations
+        def test():
+            for double in doubles:
+                stubydoo.expect(double, 'method').with_args(1)
+                double.method(1)
+        test()
+
+
 class TestFunctionStub(unittest.TestCase):
     # Function stubs are currently handled by the `patch` function.  In the
     # future, this will be handled by `stub`.  Also, `expect` will handle
@@ -841,6 +1835,395 @@ class TestFunctionStub(unittest.TestCase):
         self.assertEquals(original_function(), 1)
 
 
+    def test_patched_function_keeps_its_identity(self):
+        def original_function():
+            return 1
+        function = original_function
+
+        stubydoo.patch(original_function)(lambda: 2)
+        try:
+            self.assertTrue(original_function is function)
+            self.assertEquals(function(), 2)
+        finally:
+            stubydoo.FunctionStub.clear_all()
+
+    def test_patching_again_replaces_previous_patch(self):
+        def original_function():
+            return 1
+
+        stubydoo.patch(original_function)(lambda: 2)
+        stubydoo.patch(original_function)(lambda: 3)
+        try:
+            self.assertEquals(original_function(), 3)
+        finally:
+            stubydoo.FunctionStub.clear_all()
+        self.assertEquals(original_function(), 1)
+
+    def test_functions_with_different_closures_can_be_patched(self):
+        a, b, c = 1, 2, 3
+
+        def first():
+            return a
+
+        def second():
+            return b + c
+
+        stubydoo.patch(first)(lambda: 'first')
+        stubydoo.patch(second)(lambda: 'second')
+        try:
+            self.assertEquals(first(), 'first')
+            self.assertEquals(second(), 'second')
+        finally:
+            stubydoo.FunctionStub.clear_all()
+        self.assertEquals(first(), 1)
+        self.assertEquals(second(), 5)
+
+    def test_patched_function_receives_all_arguments(self):
+        def original_function(*args, **kw):
+            return None
+
+        stubydoo.patch(original_function)(lambda *a, **kw: (a, kw))
+        try:
+            self.assertEquals(original_function(1, 2, args=3, kw=4),
+                              ((1, 2), {'args': 3, 'kw': 4}))
+        finally:
+            stubydoo.FunctionStub.clear_all()
+
+
+class TestScopedFunctionStub(unittest.TestCase):
+
+    def setUp(self):
+        def original_function(value):
+            return ('original', value)
+        self.function = original_function
+
+    def tearDown(self):
+        stubydoo.FunctionStub.clear_all()
+
+    def call_in_thread(self, fn):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fn()))
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test_patch_is_only_seen_by_the_patching_thread(self):
+        stubydoo.patch(self.function, scoped=True)(lambda value: 'patched')
+        self.assertEquals(self.function(1), 'patched')
+        self.assertEquals(self.call_in_thread(lambda: self.function(1)),
+                          ('original', 1))
+
+    def test_each_thread_sees_its_own_patch(self):
+        stubydoo.patch(self.function, scoped=True)(lambda value: 'main')
+
+        def other_thread():
+            stubydoo.patch(self.function, scoped=True)(lambda value: 'other')
+            return self.function(1)
+
+        self.assertEquals(self.call_in_thread(other_thread), 'other')
+        self.assertEquals(self.function(1), 'main')
+
+    def test_function_is_restored_when_last_context_is_cleared(self):
+        stubydoo.patch(self.function, scoped=True)(lambda value: 'main')
+
+        def other_thread():
+            stubydoo.patch(self.function, scoped=True)(lambda value: 'other')
+            stubydoo.FunctionStub.clear_context()
+            return self.function(1)
+
+        self.assertEquals(self.call_in_thread(other_thread), ('original', 1))
+        self.assertTrue(stubydoo.FunctionStub(self.function).is_patched())
+        stubydoo.FunctionStub.clear_context()
+        self.assertFalse(stubydoo.FunctionStub(self.function).is_patched())
+        self.assertEquals(self.function(1), ('original', 1))
+
+    def test_assertion_only_clears_patches_of_its_own_context(self):
+        stubydoo.patch(self.function, scoped=True)(lambda value: 'main')
+
+        @stubydoo.assert_expectations
+        def other_test():
+            stubydoo.patch(self.function, scoped=True)(
+                lambda value: 'other'
+            )
+
+        self.call_in_thread(other_test)
+        self.assertEquals(self.function(1), 'main')
+
+    def test_scoped_patches_fall_back_to_the_global_one(self):
+        stubydoo.patch(self.function)(lambda value: 'global')
+
+        def other_thread():
+            stubydoo.patch(self.function, scoped=True)(
+                lambda value: 'scoped'
+            )
+            return self.function(1)
+
+        self.assertEquals(self.call_in_thread(other_thread), 'scoped')
+        self.assertEquals(self.function(1), 'global')
+
+    def test_global_patch_outlives_scoped_patches_of_other_threads(self):
+        stubydoo.patch(self.function)(lambda value: 'global')
+
+        def other_thread():
+            stubydoo.patch(self.function, scoped=True)(
+                lambda value: 'scoped'
+            )
+            stubydoo.FunctionStub.clear_context()
+            return self.function(1)
+
+        self.assertEquals(self.call_in_thread(other_thread), 'global')
+        self.assertEquals(self.function(1), 'global')
+        stubydoo.FunctionStub.clear_context()
+        self.assertEquals(self.function(1), ('original', 1))
+
+    def test_scoped_patches_outlive_the_global_one(self):
+        stubydoo.patch(self.function, scoped=True)(lambda value: 'scoped')
+
+        def other_thread():
+            stubydoo.patch(self.function)(lambda value: 'global')
+            stubydoo.FunctionStub.clear_context()
+            return self.function(1)
+
+        self.assertEquals(self.call_in_thread(other_thread), ('original', 1))
+        self.assertEquals(self.function(1), 'scoped')
+
+
+class TestScope(unittest.TestCase):
+
+    def setUp(self):
+        class myobject(object):
+            attribute = 'class attribute'
+
+            def method(self, *args):
+                return 'original'
+        self.object = myobject()
+        self.object.value = 'original'
+
+        def original_function():
+            return 'original'
+        self.function = original_function
+
+    def tearDown(self):
+        stubydoo.FunctionStub.clear_all()
+        stubydoo.assert_expectations()
+
+    def test_attribute_stubs_are_rolled_back(self):
+        with stubydoo.scope():
+            stubydoo.stub(self.object, value='stubbed',
+                          attribute='stubbed', new='stubbed')
+            self.assertEquals(self.object.value, 'stubbed')
+        self.assertEquals(self.object.value, 'original')
+        self.assertEquals(self.object.attribute, 'class attribute')
+        self.assertFalse('attribute' in self.object.__dict__)
+        self.assertFalse(hasattr(self.object, 'new'))
+        self.assertFalse(hasattr(self.object, '_replaced_attributes_'))
+
+    def test_method_stubs_are_rolled_back(self):
+        original_class = self.object.__class__
+        with stubydoo.scope():
+            stubydoo.stub(self.object.method).and_return('stubbed')
+            stubydoo.stub(self.object, 'other').and_return('stubbed')
+            self.assertEquals(self.object.method(), 'stubbed')
+        self.assertEquals(self.object.method(), 'original')
+        self.assertFalse(hasattr(self.object, 'other'))
+        self.assertTrue(self.object.__class__ is original_class)
+
+    def test_expectations_are_rolled_back(self):
+        with stubydoo.scope():
+            stubydoo.expect(self.object.method).once.and_return('stubbed')
+            self.assertEquals(self.object.method(), 'stubbed')
+        stubydoo.assert_expectations()
+        self.assertEquals(self.object.method(), 'original')
+
+    def test_unmet_expectations_fail_the_scope(self):
+        def test():
+            with stubydoo.scope():
+                stubydoo.expect(self.object.method).once
+        self.assertRaises(stubydoo.ExpectationNotSatisfiedError, test)
+        stubydoo.assert_expectations()
+        self.assertEquals(self.object.method(), 'original')
+
+    def test_unmet_expectations_do_not_hide_errors_of_the_scope(self):
+        class MyError(Exception):
+            pass
+
+        def test():
+            with stubydoo.scope():
+                stubydoo.expect(self.object.method).once
+                raise MyError
+        self.assertRaises(MyError, test)
+        self.assertEquals(self.object.method(), 'original')
+
+    def test_expectations_of_enclosing_scopes_are_left_to_them(self):
+        stubydoo.expect(self.object.method).once.and_return('outer')
+        with stubydoo.scope():
+            stubydoo.expect(self.object.method).with_args(1).\
+                and_return('inner')
+            self.assertEquals(self.object.method(1), 'inner')
+        self.assertEquals(self.object.method(), 'outer')
+
+    def test_function_patches_are_rolled_back(self):
+        with stubydoo.scope():
+            stubydoo.patch(self.function)(lambda: 'stubbed')
+            self.assertEquals(self.function(), 'stubbed')
+        self.assertEquals(self.function(), 'original')
+        self.assertFalse(stubydoo.FunctionStub(self.function).is_patched())
+
+    def test_nested_scopes_roll_back_independently(self):
+        with stubydoo.scope():
+            stubydoo.stub(self.object, value='outer')
+            stubydoo.stub(self.object.method).and_return('outer')
+            stubydoo.stub(self.object.method).with_args(1).\
+                and_return('outer one')
+            stubydoo.patch(self.function)(lambda: 'outer')
+            with stubydoo.scope():
+                stubydoo.stub(self.object, value='inner')
+                stubydoo.stub(self.object.method).and_return('inner')
+                stubydoo.stub(self.object.method).with_args(1).\
+                    and_return('inner one')
+                stubydoo.patch(self.function)(lambda: 'inner')
+                self.assertEquals(self.object.value, 'inner')
+                self.assertEquals(self.object.method(), 'inner')
+                self.assertEquals(self.object.method(1), 'inner one')
+                self.assertEquals(self.function(), 'inner')
+            self.assertEquals(self.object.value, 'outer')
+            self.assertEquals(self.object.method(), 'outer')
+            self.assertEquals(self.object.method(1), 'outer one')
+            self.assertEquals(self.function(), 'outer')
+        self.assertEquals(self.object.value, 'original')
+        self.assertEquals(self.object.method(), 'original')
+        self.assertEquals(self.function(), 'original')
+
+    def test_rolling_back_after_unstubbing_does_nothing(self):
+        with stubydoo.scope():
+            stubydoo.stub(self.object, value='stubbed')
+            stubydoo.stub(self.object.method).and_return('stubbed')
+            stubydoo.unstub(self.object, 'value')
+            stubydoo.unstub(self.object.method)
+            self.object.value = 'changed'
+        self.assertEquals(self.object.value, 'changed')
+        self.assertEquals(self.object.method(), 'original')
+
+    def test_changes_are_rolled_back_when_expectations_are_verified(self):
+        stubydoo.stub(self.object, value='stubbed')
+        stubydoo.stub(self.object.method).and_return('stubbed')
+        stubydoo.assert_expectations()
+        self.assertEquals(self.object.value, 'original')
+        self.assertEquals(self.object.method(), 'original')
+
+    def test_scope_is_rolled_back_on_errors(self):
+        def fail():
+            with stubydoo.scope():
+                stubydoo.stub(self.object, value='stubbed')
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEquals(self.object.value, 'original')
+
+
+class TestWeakRegistries(unittest.TestCase):
+
+    def setUp(self):
+        class myobject(object):
+            def method(self):
+                return 'original'
+        self.myobject = myobject
+        stubydoo.collected_while_patched.clear()
+
+    def tearDown(self):
+        stubydoo.FunctionStub.clear_all()
+        stubydoo.assert_expectations()
+        stubydoo.collected_while_patched.clear()
+
+    def assertCollected(self, reference):
+        gc.collect()
+        self.assertTrue(reference() is None)
+
+    def test_stubbed_instances_are_not_kept_alive(self):
+        instance = self.myobject()
+        stubydoo.stub(instance.method).and_return('stubbed')
+        stubydoo.stub(instance, attribute='stubbed')
+        reference = weakref.ref(instance)
+        del instance
+        self.assertCollected(reference)
+
+    def test_instances_with_satisfied_expectations_are_not_kept_alive(self):
+        instance = self.myobject()
+        stubydoo.expect(instance.method).once
+        instance.method()
+        reference = weakref.ref(instance)
+        del instance
+        self.assertCollected(reference)
+        self.assertEquals(
+            len(stubydoo._context().instances_with_expectations), 0
+        )
+
+    def test_journal_drops_entries_of_collected_objects(self):
+        with stubydoo.scope() as journal:
+            for i in range(3000):
+                stubydoo.stub(self.myobject(), attribute='stubbed')
+            gc.collect()
+            stubydoo.stub(self.myobject(), attribute='stubbed')
+            self.assertTrue(len(journal) < 2048)
+
+    def test_instances_collected_while_patched_are_reported(self):
+        instance = self.myobject()
+        stubydoo.stub(instance.method)
+        description = '<myobject object at %#x>' % id(instance)
+        del instance
+        gc.collect()
+        self.assertEquals(list(stubydoo.collected_while_patched),
+                          [description])
+
+    def test_unpatched_instances_are_not_reported(self):
+        instance = self.myobject()
+        stubydoo.stub(instance.method)
+        stubydoo.unstub(instance.method)
+        del instance
+        gc.collect()
+        self.assertEquals(list(stubydoo.collected_while_patched), [])
+
+    def test_patched_functions_are_not_kept_alive(self):
+        def function():
+            return 'original'
+        stubydoo.patch(function)(lambda: 'stubbed')
+        description = '<function function at %#x>' % id(function)
+        reference = weakref.ref(function)
+        del function
+        self.assertCollected(reference)
+        self.assertEquals(list(stubydoo.collected_while_patched),
+                          [description])
+        self.assertEquals(stubydoo.FunctionStub._patches, {})
+
+    def test_repatching_a_function_with_the_id_of_a_collected_one(self):
+        def make_function():
+            def function():
+                return 'original'
+            return function
+        for i in range(10):
+            function = make_function()
+            stubydoo.patch(function)(lambda: 'stubbed')
+            self.assertEquals(function(), 'stubbed')
+            del function
+            gc.collect()
+        function = make_function()
+        self.assertFalse(stubydoo.FunctionStub(function).is_patched())
+        self.assertEquals(function(), 'original')
+
+    def test_objects_which_cannot_be_referenced_weakly(self):
+        class slotted(object):
+            __slots__ = ('__dict__',)
+
+            def method(self):
+                return 'original'
+        instance = slotted()
+        stubydoo.stub(instance, attribute='stubbed')
+        stubydoo.expect(instance.method).and_return('stubbed')
+        self.assertEquals(instance.method(), 'stubbed')
+        stubydoo.assert_expectations()
+        self.assertEquals(instance.method(), 'original')
+        self.assertFalse(hasattr(instance, 'attribute'))
+
+
 class TestExpectationAssertionNotAsADecorator(unittest.TestCase):
 
     def setUp(self):
@@ -883,6 +2266,172 @@ class TestExpectationErrorWhenNotVerifiedPreviousOnes(unittest.TestCase):
             pass
 
 
+class TestExpectationsInConcurrentThreads(unittest.TestCase):
+
+    def run_in_thread(self, fn):
+        errors = []
+
+        def target():
+            try:
+                fn()
+            except Exception as exc:
+                errors.append(exc)
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        return errors
+
+    def test_expectations_from_other_threads_are_not_verified(self):
+        double = stubydoo.double()
+        other_thread_set_expectation = threading.Event()
+        may_verify = threading.Event()
+        errors = []
+
+        def other_test():
+            stubydoo.expect(double, 'method')
+            other_thread_set_expectation.set()
+            may_verify.wait()
+            try:
+                stubydoo.assert_expectations()
+            except stubydoo.ExpectationNotSatisfiedError as exc:
+                errors.append(exc)
+
+        thread = threading.Thread(target=other_test)
+        thread.start()
+        other_thread_set_expectation.wait()
+
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(stubydoo.double(), 'method').to_not_be_called
+        try:
+            test()
+        finally:
+            may_verify.set()
+            thread.join()
+        self.assertEquals(len(errors), 1)
+
+    def test_unverified_expectations_in_other_thread_are_not_reported(self):
+        def forgetful_test():
+            stubydoo.expect(stubydoo.double(), 'method')
+        self.assertEquals(self.run_in_thread(forgetful_test), [])
+
+        @stubydoo.assert_expectations
+        def test():
+            pass
+        test()
+
+
+class TestSharedCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.counters = stubydoo.share_calls(capacity=4)
+        self.double = stubydoo.double()
+
+    def tearDown(self):
+        stubydoo.stop_sharing_calls()
+        try:
+            stubydoo.assert_expectations()
+        except AssertionError:
+            pass
+
+    def call_in_child_process(self, method):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                method()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    if hasattr(os, 'fork'):
+        def test_calls_in_child_processes_are_counted(self):
+            @stubydoo.assert_expectations
+            def test():
+                stubydoo.expect(self.double, 'method').twice
+                self.double.method()
+                self.call_in_child_process(self.double.method)
+            test()
+
+        def test_calls_only_in_child_processes_satisfy(self):
+            @stubydoo.assert_expectations
+            def test():
+                stubydoo.expect(self.double, 'method')
+                self.call_in_child_process(self.double.method)
+            test()
+
+        def test_too_many_calls_in_child_processes(self):
+            @stubydoo.assert_expectations
+            def test():
+                stubydoo.expect(self.double, 'method').once
+                self.double.method()
+                self.call_in_child_process(self.double.method)
+            self.assertRaises(stubydoo.ExpectationNotSatisfiedError, test)
+
+    def test_counters_of_expectations_withdrawn_are_given_back(self):
+        for i in range(5):
+            with stubydoo.scope():
+                stubydoo.expect(self.double, 'method').once
+                self.double.method()
+        self.assertEquals(len(self.counters), 0)
+
+    def test_counters_of_expectations_unstubbed_are_given_back(self):
+        stubydoo.expect(self.double, 'method').once
+        stubydoo.unstub(self.double.method)
+        self.assertEquals(len(self.counters), 0)
+
+    def test_replaced_expectations_keep_their_calls(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method').with_args(1).once
+            self.double.method(1)
+            with stubydoo.scope():
+                stubydoo.expect(self.double, 'method').with_args(1).\
+                    to_not_be_called
+                self.assertEquals(len(self.counters), 1)
+        test()
+
+    def test_missing_calls_are_still_reported(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method').twice
+            self.double.method()
+        self.assertRaises(stubydoo.ExpectationNotSatisfiedError, test)
+
+    def test_expectations_without_limits_need_a_call(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method').any_number_of_times
+        self.assertRaises(stubydoo.ExpectationNotSatisfiedError, test)
+
+    def test_expectations_not_to_be_called(self):
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method').to_not_be_called
+        test()
+
+    def test_counters_are_released_when_verified(self):
+        stubydoo.expect(self.double, 'method')
+        stubydoo.stub(self.double, 'other')
+        self.assertEquals(len(self.counters), 1)
+        self.double.method()
+        stubydoo.assert_expectations()
+        self.assertEquals(len(self.counters), 0)
+
+    def test_running_out_of_counters(self):
+        for i in range(4):
+            self.counters.allocate()
+        self.assertRaises(RuntimeError, stubydoo.expect, self.double,
+                          'method')
+
+    def test_expectations_set_before_sharing_count_locally(self):
+        stubydoo.stop_sharing_calls()
+        expectation = stubydoo.expect(self.double, 'method')
+        stubydoo.share_calls()
+        self.double.method()
+        self.assertEquals(expectation.calls, 1)
+        stubydoo.assert_expectations()
+
+
 class TestAssertionDecoratorInClasses(unittest.TestCase):
 
     def test_failing_assertion(self):
@@ -924,6 +2473,60 @@ class TestDouble(unittest.TestCase):
         self.assertEquals(double.method(), 'another value')
 
 
+    def test_doubles_with_the_same_methods_share_their_type(self):
+        method = lambda self: 'value'
+        first = stubydoo.double(method=method, attribute=1)
+        second = stubydoo.double(method=method, attribute=2)
+        self.assertTrue(type(first) is type(second))
+        self.assertEquals(first.attribute, 1)
+        self.assertEquals(second.attribute, 2)
+
+    def test_stubbing_a_double_does_not_affect_others_of_its_type(self):
+        method = lambda self: 'value'
+        first = stubydoo.double(method=method)
+        second = stubydoo.double(method=method)
+        stubydoo.stub(first.method).and_return('another value')
+        self.assertEquals(first.method(), 'another value')
+        self.assertEquals(second.method(), 'value')
+
+    def test_doubles_with_inline_lambdas_share_their_type(self):
+        types = set(type(stubydoo.double(method=lambda self: 'value'))
+                    for i in range(2))
+        self.assertEquals(len(types), 1)
+
+    def test_lambdas_closing_over_other_objects_are_told_apart(self):
+        def make_double(value):
+            return stubydoo.double(method=lambda self: value)
+        first, second = make_double([1]), make_double([2])
+        self.assertTrue(type(first) is not type(second))
+        self.assertEquals(first.method(), [1])
+        self.assertEquals(second.method(), [2])
+
+    def test_lambdas_closing_over_other_variables_are_told_apart(self):
+        def make_double():
+            box = None
+
+            def get(self):
+                return box
+            return stubydoo.double(get=get), get
+        first, first_get = make_double()
+        second, second_get = make_double()
+        self.assertTrue(type(first) is not type(second))
+        self.assertTrue(type(second).__dict__['get'] is second_get)
+
+    def test_interned_types_are_bounded(self):
+        interned_types = stubydoo.InternedTypes(maxsize=2)
+        first_method = lambda self: 1
+        types = [interned_types.get(object, dict(method=first_method)),
+                 interned_types.get(object, dict(method=lambda self: 2)),
+                 interned_types.get(object, dict(method=lambda self: 3))]
+        self.assertEquals(len(interned_types), 2)
+        self.assertTrue(
+            interned_types.get(object, dict(method=first_method)) is not
+            types[0]
+        )
+
+
 class TestMock(unittest.TestCase):
 
     def test_attributes(self):
@@ -957,6 +2560,21 @@ class TestNull(unittest.TestCase):
         stubydoo.stub(null.method).and_return('another value')
         self.assertEquals(null.method(), 'another value')
 
+    def test_nulls_share_their_type(self):
+        self.assertTrue(type(stubydoo.null()) is type(self.null))
+
+    def test_nulls_with_attributes_share_their_type(self):
+        self.assertTrue(type(stubydoo.null(attribute='value')) is
+                        type(self.null))
+
+    def test_null_can_be_stubbed_again_after_unstubbing(self):
+        stubydoo.stub(self.null, 'method').and_return('value')
+        stubydoo.unstub(self.null.method)
+        stubydoo.stub(self.null, 'method').and_return('another value')
+        self.assertEquals(self.null.method(), 'another value')
+        other_null = stubydoo.null()
+        self.assertTrue(other_null.method() is other_null)
+
     def test_null_can_be_positivated(self):
         self.assertTrue((+self.null) is self.null)
 
@@ -1103,26 +2721,209 @@ class TestNull(unittest.TestCase):
         self.assertTrue(self.null('arg', 1, foo='bar') is self.null)
 
 
+def describe(self):
+    return 'described %s' % self.attribute
+
+
+class TestPickling(unittest.TestCase):
+
+    def round_trip(self, instance):
+        return pickle.loads(pickle.dumps(instance, pickle.HIGHEST_PROTOCOL))
+
+    def test_double_attributes_are_kept(self):
+        double = self.round_trip(stubydoo.double(attribute='value'))
+        self.assertEquals(double.attribute, 'value')
+
+    def test_double_methods_are_kept(self):
+        double = stubydoo.double(attribute=1, describe=describe)
+        copy = self.round_trip(double)
+        self.assertEquals(copy.describe(), 'described 1')
+        self.assertTrue(type(copy) is type(double))
+
+    def test_lambdas_are_kept(self):
+        double = stubydoo.double(attribute=1,
+                                 describe=lambda self: 'lambda %s' %
+                                 self.attribute)
+        self.assertEquals(self.round_trip(double).describe(), 'lambda 1')
+
+    def test_nested_functions_are_kept_with_their_defaults(self):
+        def describe(self, prefix='nested'):
+            return '%s %s' % (prefix, self.attribute)
+        double = stubydoo.null(attribute=1, describe=describe)
+        self.assertEquals(self.round_trip(double).describe(), 'nested 1')
+
+    def test_functions_referring_to_enclosing_variables_fail(self):
+        prefix = 'closure'
+        double = stubydoo.double(describe=lambda self: prefix)
+        try:
+            pickle.dumps(double, pickle.HIGHEST_PROTOCOL)
+        except pickle.PicklingError as error:
+            self.assertTrue("'describe'" in str(error))
+        else:
+            self.fail()
+
+    def test_mock_still_refuses_unknown_attributes(self):
+        mock = self.round_trip(stubydoo.mock(attribute='value'))
+        self.assertEquals(mock.attribute, 'value')
+        self.assertRaises(stubydoo.UnexpectedAttributeAccessError,
+                          getattr, mock, 'unknown')
+
+    def test_null_still_returns_itself(self):
+        null = self.round_trip(stubydoo.null(attribute='value'))
+        self.assertEquals(null.attribute, 'value')
+        self.assertTrue(null.unknown() is null)
+
+    def test_references_to_itself_are_kept(self):
+        double = stubydoo.double()
+        double.itself = double
+        copy = self.round_trip(double)
+        self.assertTrue(copy.itself is copy)
+
+    def test_stubs_are_not_pickled(self):
+        double = stubydoo.double(attribute='value')
+        stubydoo.stub(double, 'method').and_return(1)
+        stubydoo.stub(double, attribute='stubbed')
+        copy = self.round_trip(double)
+        stubydoo.unstub(double.method)
+        self.assertEquals(copy.attribute, 'stubbed')
+        self.assertFalse(hasattr(copy, 'method'))
+        self.assertFalse(hasattr(copy, '_expectations_'))
+
+    def test_doubles_without_attributes_pickle_small(self):
+        self.assertTrue(len(pickle.dumps(stubydoo.double(), 2)) < 64)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.double = stubydoo.double()
+        self.instrumentation = stubydoo.instrument()
+
+    def tearDown(self):
+        stubydoo.stop_instrumenting()
+
+    def test_calls_are_counted_per_stub(self):
+        generic = stubydoo.stub(self.double, 'method')
+        specific = stubydoo.stub(self.double, 'method').with_args(1)
+        self.double.method(1)
+        self.double.method(2)
+        self.double.method(3)
+        statistics = self.instrumentation.statistics
+        self.assertEquals(statistics[generic].calls, 2)
+        self.assertEquals(statistics[specific].calls, 1)
+        self.assertTrue(statistics[generic].time >= 0)
+
+    def test_unmatched_calls_are_counted_as_misses(self):
+        stubydoo.stub(self.double, 'method').with_args(1)
+        self.assertRaises(stubydoo.UnexpectedCallError,
+                          self.double.method, 2)
+        [record] = self.instrumentation.export()
+        self.assertEquals(record['misses'], 1)
+        self.assertEquals(record['calls'], 0)
+
+    def test_function_stub_calls_are_counted(self):
+        def function():
+            return 1
+        stubydoo.patch(function)(lambda: 2)
+        try:
+            function()
+        finally:
+            stubydoo.FunctionStub.clear_all()
+        [record] = self.instrumentation.export()
+        self.assertEquals(record['calls'], 1)
+
+    def test_export_can_reset_the_statistics(self):
+        stubydoo.stub(self.double, 'method')
+        self.double.method()
+        self.assertEquals(len(self.instrumentation.export(reset=True)), 1)
+        self.assertEquals(self.instrumentation.export(), [])
+
+    def test_hooks_are_called_for_each_event(self):
+        events = []
+
+        def recorder(event):
+            return lambda *details: events.append(event)
+        for event in stubydoo.Instrumentation.events:
+            self.instrumentation.add_hook(event, recorder(event))
+
+        @stubydoo.assert_expectations
+        def test():
+            stubydoo.expect(self.double, 'method').with_args(1)
+            self.double.method(1)
+            self.assertRaises(stubydoo.UnexpectedCallError,
+                              self.double.method, 2)
+        test()
+        self.assertEquals(events,
+                          ['install', 'call', 'miss', 'verify', 'teardown'])
+
+    def test_nothing_is_recorded_when_stopped(self):
+        stubydoo.stop_instrumenting()
+        stubydoo.stub(self.double, 'method')
+        self.double.method()
+        self.assertEquals(self.instrumentation.export(), [])
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_benchmarks_run(self):
+        from stubydoo import benchmarks
+        results = benchmarks.run_benchmarks(['construction'], scale=0.001,
+                                            repeat=1)
+        self.assertTrue('null construction' in results)
+        self.assertTrue(all(value > 0 for value in results.values()))
+
+    def test_slower_results_are_regressions(self):
+        from stubydoo import benchmarks
+        results = {'fast': 100.0, 'slow': 70.0, 'new': 1.0}
+        baseline = {'fast': 110.0, 'slow': 100.0, 'gone': 1.0}
+        self.assertEquals(benchmarks.compare(results, baseline, 0.2),
+                          [('slow', 0.7)])
+
+
 def test_suite():
-    return unittest.TestSuite([
+    suite = unittest.TestSuite([
         unittest.makeSuite(TestStubMethod),
         unittest.makeSuite(TestStubCallsInExistingMethod),
         unittest.makeSuite(TestUnstubbingUnstubbedMethod),
         unittest.makeSuite(TestUnstubbingCallsInNonExistingMethod),
         unittest.makeSuite(TestUnstubbingCallsInExistingMethod),
+        unittest.makeSuite(TestStubbingManyInstancesOfTheSameClass),
+        unittest.makeSuite(TestCompactStubs),
+        unittest.makeSuite(TestStubMany),
+        unittest.makeSuite(TestAutospec),
+        unittest.makeSuite(TestNormalizedArguments),
         unittest.makeSuite(TestStubAttributes),
         unittest.makeSuite(TestArgumentMatching),
+        unittest.makeSuite(TestManyArgumentVariants),
+        unittest.makeSuite(TestLargePayloads),
+        unittest.makeSuite(TestMatchers),
         unittest.makeSuite(TestStubException),
         unittest.makeSuite(TestStubUsingCustomFunctionAsReturningValue),
+        unittest.makeSuite(TestReturnSequence),
         unittest.makeSuite(TestStubIterator),
         unittest.makeSuite(TestExpectations),
+        unittest.makeSuite(TestOrderedExpectations),
+        unittest.makeSuite(TestSpies),
+        unittest.makeSuite(TestExpectationsTracking),
         unittest.makeSuite(TestFunctionStub),
+        unittest.makeSuite(TestScopedFunctionStub),
+        unittest.makeSuite(TestScope),
+        unittest.makeSuite(TestWeakRegistries),
         unittest.makeSuite(TestExpectationAssertionNotAsADecorator),
         unittest.makeSuite(TestExpectationErrorWhenNotVerifiedPreviousOnes),
+        unittest.makeSuite(TestExpectationsInConcurrentThreads),
+        unittest.makeSuite(TestSharedCalls),
         unittest.makeSuite(TestAssertionDecoratorInClasses),
         unittest.makeSuite(TestDouble),
         unittest.makeSuite(TestMock),
         unittest.makeSuite(TestNull),
+        unittest.makeSuite(TestPickling),
+        unittest.makeSuite(TestInstrumentation),
+        unittest.makeSuite(TestBenchmarks),
         doctest.DocFileSuite(os.path.join('..', '..', 'README.rst'),
                              optionflags=doctest.ELLIPSIS)
     ])
+    if sys.version_info >= (3, 6):
+        from stubydoo import tests_async
+        suite.addTest(tests_async.test_suite())
+    return suite
@@ -0,0 +1,174 @@
+import asyncio
+import stubydoo
+import unittest
+
+
+class Service(object):
+
+    async def fetch(self, key):
+        return 'original'
+
+    async def stream(self):
+        yield 'original'
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestStubCoroutineMethod(unittest.TestCase):
+
+    def setUp(self):
+        self.service = Service()
+
+    def test_return_value_is_awaited(self):
+        stubydoo.stub(self.service.fetch).and_return('value')
+
+        async def test():
+            return await self.service.fetch('key')
+        self.assertEquals(run(test()), 'value')
+
+    def test_exception_is_raised_when_awaited(self):
+        class MyError(Exception):
+            pass
+        stubydoo.stub(self.service.fetch).and_raise(MyError)
+        awaitable = self.service.fetch('key')
+
+        async def test():
+            await awaitable
+        self.assertRaises(MyError, run, test())
+
+    def test_arguments_are_matched(self):
+        stubydoo.stub(self.service.fetch).with_args('a').and_return(1)
+        stubydoo.stub(self.service.fetch).with_args('b').and_return(2)
+
+        async def test():
+            return [await self.service.fetch('b'),
+                    await self.service.fetch('a')]
+        self.assertEquals(run(test()), [2, 1])
+
+    def test_yielded_values_are_iterated_asynchronously(self):
+        stubydoo.stub(self.service.fetch).and_yield(1, 2, 3)
+
+        async def test():
+            return [value async for value in self.service.fetch('key')]
+        self.assertEquals(run(test()), [1, 2, 3])
+
+    def test_awaitables_can_be_gathered(self):
+        stubydoo.stub(self.service.fetch).and_return('value')
+
+        async def test():
+            return await asyncio.gather(*[self.service.fetch(i)
+                                          for i in range(3)])
+        self.assertEquals(run(test()), ['value'] * 3)
+
+    def test_coroutines_run_by_the_stub_are_awaited(self):
+        async def fetch(key):
+            await asyncio.sleep(0)
+            return 'fetched %s' % key
+        stubydoo.stub(self.service.fetch).and_run(fetch)
+
+        async def test():
+            return await self.service.fetch('key')
+        self.assertEquals(run(test()), 'fetched key')
+
+    def test_returned_futures_are_awaited(self):
+        async def test():
+            future = asyncio.get_event_loop().create_future()
+            stubydoo.stub(self.service.fetch).and_return(future)
+            asyncio.get_event_loop().call_soon(future.set_result, 'value')
+            return await self.service.fetch('key')
+        self.assertEquals(run(test()), 'value')
+
+    def test_exceptions_of_awaited_outputs_are_raised(self):
+        class MyError(Exception):
+            pass
+
+        async def fetch(key):
+            await asyncio.sleep(0)
+            raise MyError
+        stubydoo.stub(self.service.fetch).and_run(fetch)
+
+        async def test():
+            await self.service.fetch('key')
+        self.assertRaises(MyError, run, test())
+
+    def test_double_methods_can_be_made_asynchronous(self):
+        double = stubydoo.double()
+        stubydoo.stub(double, 'fetch').asynchronously.and_return('value')
+
+        async def test():
+            return await double.fetch()
+        self.assertEquals(run(test()), 'value')
+
+
+class TestStubAsyncGeneratorMethod(unittest.TestCase):
+
+    def test_yielded_values_are_iterated_asynchronously(self):
+        service = Service()
+        stubydoo.stub(service.stream).and_yield('a', 'b')
+
+        async def test():
+            return [value async for value in service.stream()]
+        self.assertEquals(run(test()), ['a', 'b'])
+
+
+class TestExpectCoroutineMethod(unittest.TestCase):
+
+    def test_calls_and_awaits_are_counted(self):
+        service = Service()
+
+        @stubydoo.assert_expectations
+        def test():
+            expectation = stubydoo.expect(service.fetch).twice.\
+                and_return('value')
+            service.fetch('not awaited')
+            run(self.await_all(service.fetch('awaited')))
+            return expectation
+
+        expectation = test()
+        self.assertEquals(expectation.calls, 2)
+        self.assertEquals(expectation.awaits, 1)
+
+    async def await_all(self, *awaitables):
+        return [await awaitable for awaitable in awaitables]
+
+
+class TestExpectationsInTasks(unittest.TestCase):
+
+    def test_expectations_set_in_tasks_are_verified(self):
+        double = stubydoo.double()
+
+        async def test():
+            stubydoo.expect(double, 'method').once
+        run(test())
+        self.assertRaises(stubydoo.ExpectationNotSatisfiedError,
+                          stubydoo.assert_expectations)
+        self.assertFalse(hasattr(double, '_expectations_'))
+
+    def test_isolated_tasks_keep_their_expectations(self):
+        async def task():
+            stubydoo.isolate()
+            stubydoo.expect(stubydoo.double(), 'method')
+            try:
+                stubydoo.assert_expectations()
+            except stubydoo.ExpectationNotSatisfiedError:
+                return 'failed'
+
+        async def test():
+            return await asyncio.gather(task(), task())
+        self.assertEquals(run(test()), ['failed', 'failed'])
+        stubydoo.assert_expectations()
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(TestStubCoroutineMethod),
+        unittest.makeSuite(TestStubAsyncGeneratorMethod),
+        unittest.makeSuite(TestExpectCoroutineMethod),
+        unittest.makeSuite(TestExpectationsInTasks),
+    ])